@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+Load generator for server.py (or anything else that talks the protocol).
+
+Opens a number of concurrent client connections, each of which fires
+a fixed cycle of transparent requests at the server at a configurable
+rate, keeping up to --window of them in flight (pipelined) at once.
+At the end, reports throughput, latency percentiles, and the number
+of responses which went missing or didn't match the request.
+
+The request cycle is fixed, so runs are repeatable: use it to get
+a number before and after a change to the server.
+
+  python server.py &
+  python bench.py -c 100 -r 20 -d 10
+
+Responses are matched to requests in order - the server answers each
+connection's requests in the order they arrive. If the server is
+broadcasting responses (server.py --broadcast), every client sees every
+response, so use a single client, plus --watchers to add passive
+connections and measure the cost of the fan-out. Don't point this at
+a real dongle: that broadcasts responses to every client, and the writes
+would go to a real inverter.
+"""
+
+import argparse
+import asyncio
+import time
+from collections import deque
+
+from givenergy_modbus.exceptions import ExceptionBase
+from givenergy_modbus.pdu import HeartbeatRequest
+from givenergy_modbus.pdu.framer import ClientFramer
+from givenergy_modbus.pdu.transparent import (
+    TransparentResponse,
+    ReadInputRegistersRequest,
+    ReadHoldingRegistersRequest,
+    WriteHoldingRegisterRequest,
+)
+
+
+def request_cycle(write_every, write_reg, write_value):
+    """Build the list of (encoded request, expected response key) which each client cycles through."""
+
+    reqs = [
+        ReadInputRegistersRequest(slave_address=0x32, base_register=0, register_count=60),
+        ReadInputRegistersRequest(slave_address=0x32, base_register=60, register_count=60),
+    ]
+    reqs += [
+        ReadHoldingRegistersRequest(slave_address=0x32, base_register=base, register_count=60)
+        for base in range(0, 360, 60)
+    ]
+
+    if write_every > 0:
+        write = WriteHoldingRegisterRequest(slave_address=0x32,
+                                            base_register=write_reg,
+                                            register_count=1,
+                                            register_values=[write_value])
+        cycle = []
+        for i in range(max(write_every, len(reqs))):
+            cycle.append(reqs[i % len(reqs)])
+            if (i + 1) % write_every == 0:
+                cycle.append(write)
+        reqs = cycle
+
+    return [(r.encode(), (r.transparent_function_code, r.slave_address, r.base_register, r.register_count))
+            for r in reqs]
+
+
+class Stats:
+    """Results accumulated across all clients."""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.malformed = 0
+        self.failed = 0      # connections which couldn't be made, or died
+        self.latencies = []  # seconds
+        self.watched = 0     # bytes received by passive watchers
+        self.last = 0.0      # when the last response or watched data arrived
+
+    def report(self, elapsed):
+        lat = sorted(self.latencies)
+
+        def pct(p):
+            if not lat:
+                return float('nan')
+            return lat[min(len(lat) - 1, int(len(lat) * p / 100))] * 1000
+
+        print(f"elapsed     {elapsed:8.2f} s")
+        print(f"sent        {self.sent:8d}")
+        print(f"received    {self.received:8d}  ({self.received / elapsed:.1f} req/s)")
+        print(f"latency     p50 {pct(50):.2f} ms  p95 {pct(95):.2f} ms  p99 {pct(99):.2f} ms")
+        print(f"dropped     {self.dropped:8d}")
+        print(f"malformed   {self.malformed:8d}")
+        if self.watched:
+            print(f"watchers    {self.watched / elapsed / 1e6:8.2f} MB/s")
+        if self.failed:
+            print(f"failed connections {self.failed}")
+
+
+async def client(args, port, cycle, stats, deadline):
+    """One simulated client."""
+
+    try:
+        reader, writer = await asyncio.open_connection(args.host, port)
+    except OSError as e:
+        print(e)
+        stats.failed += 1
+        return
+
+    framer = ClientFramer()
+    inflight = deque()   # (key, time sent)
+    window = asyncio.Semaphore(args.window)
+    done_sending = False
+
+    async def receive():
+        while not (done_sending and not inflight):
+            data = await reader.read(65536)
+            if not data:
+                if not done_sending:
+                    stats.failed += 1
+                return
+            now = time.perf_counter()
+            try:
+                messages = list(framer.decode(data))
+            except (ExceptionBase, NotImplementedError):
+                stats.malformed += 1
+                continue
+            for message in messages:
+                if isinstance(message, HeartbeatRequest):
+                    writer.write(message.expected_response().encode())
+                    continue
+                if not isinstance(message, TransparentResponse) or message.error:
+                    stats.malformed += 1
+                    continue
+                key = (message.transparent_function_code, message.slave_address,
+                       message.base_register, message.register_count)
+                # normally the head of the queue, but if the server
+                # skipped any, those count as dropped
+                for i, (k, t) in enumerate(inflight):
+                    if k == key:
+                        break
+                else:
+                    stats.malformed += 1
+                    continue
+                for _ in range(i):
+                    inflight.popleft()
+                    stats.dropped += 1
+                    window.release()
+                inflight.popleft()
+                window.release()
+                stats.received += 1
+                stats.latencies.append(now - t)
+                stats.last = max(stats.last, now)
+
+    receiver = asyncio.create_task(receive())
+
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    next_send = time.perf_counter()
+    n = 0
+    try:
+        while time.perf_counter() < deadline and not receiver.done():
+            try:
+                await asyncio.wait_for(window.acquire(), deadline - time.perf_counter())
+            except asyncio.TimeoutError:
+                break
+            if interval:
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            frame, key = cycle[n % len(cycle)]
+            n += 1
+            inflight.append((key, time.perf_counter()))
+            writer.write(frame)
+            stats.sent += 1
+            await writer.drain()
+
+        done_sending = True
+        if inflight:
+            try:
+                await asyncio.wait_for(receiver, args.grace)
+            except asyncio.TimeoutError:
+                pass
+    except OSError:
+        stats.failed += 1
+    finally:
+        receiver.cancel()
+        stats.dropped += len(inflight)
+        writer.close()
+
+
+async def watcher(args, port, stats, deadline):
+    """A passive client, which never sends anything and just counts what arrives.
+
+    Only gets anything if the server is broadcasting responses (server.py --broadcast).
+    """
+
+    try:
+        reader, writer = await asyncio.open_connection(args.host, port)
+    except OSError as e:
+        print(e)
+        stats.failed += 1
+        return
+    try:
+        while (remaining := deadline + args.grace - time.perf_counter()) > 0:
+            data = await asyncio.wait_for(reader.read(65536), remaining)
+            if not data:
+                break
+            stats.watched += len(data)
+            stats.last = max(stats.last, time.perf_counter())
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        writer.close()
+
+
+async def bench(args):
+    cycle = request_cycle(args.write_every, args.write_reg, args.write_value)
+    stats = Stats()
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*[client(args, args.port + n % args.ports, cycle, stats, deadline)
+                           for n in range(args.clients)],
+                         *[watcher(args, args.port + n % args.ports, stats, deadline)
+                           for n in range(args.watchers)])
+    # rates are over the time things were actually arriving, not including
+    # the grace period spent waiting for stragglers (or watchers timing out)
+    stats.report((stats.last or time.perf_counter()) - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for server.py")
+    parser.add_argument('host', nargs='?', default='127.0.0.1')
+    parser.add_argument('port', nargs='?', type=int, default=8899)
+    parser.add_argument('--ports', type=int, default=1,
+                        help="spread clients over this many consecutive ports (eg server.py -n)")
+    parser.add_argument('-c', '--clients', type=int, default=10, help="number of concurrent connections")
+    parser.add_argument('--watchers', type=int, default=0,
+                        help="number of extra passive connections (to measure server.py --broadcast fan-out)")
+    parser.add_argument('-r', '--rate', type=float, default=10.0,
+                        help="requests per second per client (0 for as fast as possible)")
+    parser.add_argument('-w', '--window', type=int, default=4, help="max requests in flight per client")
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help="seconds to send for")
+    parser.add_argument('--grace', type=float, default=2.0,
+                        help="seconds to wait for outstanding responses at the end")
+    parser.add_argument('--write-every', type=int, default=10,
+                        help="add a WRITEHOLDING after every N reads (0 for none)")
+    parser.add_argument('--write-reg', type=int, default=100, help="holding register to write")
+    parser.add_argument('--write-value', type=int, default=0, help="value to write")
+    asyncio.run(bench(parser.parse_args()))
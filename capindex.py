@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+"""
+Build a sidecar index for a capture file, so that looking at the state at
+some point in a long capture doesn't mean replaying it from the start.
+
+  python capindex.py build capture.bin ...        # writes capture.bin.idx
+  python capindex.py state capture.bin --frame 123456 [--reg HR(20) ...]
+  python capindex.py state capture.rec.gz --at 2024-01-01T12:00 # recordings have timestamps
+  python capindex.py touching capture.bin HR(20)
+
+For every frame, the index holds its offset in the (uncompressed) capture.
+It also holds the slave address, function code, base register and register
+count of each transparent response (zeros for anything else). Every --every
+frames there is a checkpoint: the plant state just before that frame. This is
+stored as the last response frame of each shape seen so far, like replay2.py -j
+uses. To get the state at frame N, start from the last checkpoint at or before
+N, and only decode the frames from there.
+
+For a recording from recorder.py, the offset of a frame is that of the record
+it starts in, since reading has to start at the start of a record, and the
+index also holds the time each frame was received.
+
+A gzip file can't be read from the middle, but a .gz file can be several gzip
+members concatenated, and each member can be decompressed on its own. The index
+notes where each member starts, so getting to a checkpoint only means
+decompressing from the start of the member containing it. A capture written as
+a single gzip member still works, but has to be decompressed (though not
+decoded) from the beginning.
+
+Index file layout:
+  magic b'CAPIDX1\\n'
+  4 byte little-endian length, then that many bytes of json header
+  then the per-frame arrays, in native byte order (noted in the header):
+    offsets (uint64), slaves (uint8), functions (uint8), bases (uint16), counts (uint16),
+    times (double: 0 for plain captures)
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+import sys
+
+from array import array
+from bisect import bisect_right
+
+from givenergy_modbus.exceptions import ExceptionBase
+from givenergy_modbus.pdu.framer import ClientFramer
+from givenergy_modbus.model.plant import Plant
+from givenergy_modbus.pdu import TransparentResponse
+from givenergy_modbus.pdu.transparent import READINPUT, READHOLDING, WRITEHOLDING
+
+from replay2 import Snapshot, frames, gunzip, is_recording, read_chunks, show
+
+MAGIC = b'CAPIDX1\n'
+
+# per-frame arrays, in the order they're stored
+COLUMNS = (('offsets', 'Q'), ('slaves', 'B'), ('functions', 'B'), ('bases', 'H'), ('counts', 'H'), ('times', 'd'))
+
+
+class Index:
+    """The index for one capture file."""
+
+    capture: str
+    header: dict
+
+    offsets: array
+    slaves: array
+    functions: array
+    bases: array
+    counts: array
+    times: array
+
+    def __init__(self, capture):
+        self.capture = capture
+        self.header = {}
+        for name, typecode in COLUMNS:
+            setattr(self, name, array(typecode))
+
+    @property
+    def filename(self):
+        return self.capture + '.idx'
+
+    @classmethod
+    def build(cls, capture, every):
+        """Read through a capture, building its index."""
+
+        idx = cls(capture)
+        members = []
+        checkpoints = []
+        last = {}
+        framer = ClientFramer()
+        stat = os.stat(capture)
+
+        for n, (offset, timestamp, frame) in enumerate(frames(read_chunks(capture, members=members))):
+            if n and n % every == 0:
+                checkpoints.append([n, offset, [f.hex() for f in last.values()]])
+            slave = function = base = count = 0
+            try:
+                for message in framer.decode(frame):
+                    if isinstance(message, TransparentResponse) and not message.error:
+                        slave = message.slave_address
+                        function = message.transparent_function_code
+                        base = message.base_register
+                        count = message.register_count
+                        key = (type(message), slave, base, count)
+                        last.pop(key, None)
+                        last[key] = frame
+            except (ExceptionBase, NotImplementedError):
+                pass
+            idx.offsets.append(offset)
+            idx.slaves.append(slave)
+            idx.functions.append(function)
+            idx.bases.append(base)
+            idx.counts.append(count)
+            idx.times.append(timestamp or 0.0)
+
+        idx.header = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'frames': len(idx.offsets),
+            'every': every,
+            'byteorder': sys.byteorder,
+            'records': is_recording(capture),
+            'members': members,
+            'checkpoints': checkpoints,
+        }
+        return idx
+
+    def write(self):
+        header = json.dumps(self.header).encode()
+        with open(self.filename, 'wb') as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(4, 'little'))
+            f.write(header)
+            for name, _ in COLUMNS:
+                getattr(self, name).tofile(f)
+
+    @classmethod
+    def load(cls, capture):
+        idx = cls(capture)
+        with open(idx.filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{idx.filename} is not a capture index')
+            length = int.from_bytes(f.read(4), 'little')
+            idx.header = json.loads(f.read(length))
+            for name, _ in COLUMNS:
+                column = getattr(idx, name)
+                column.fromfile(f, idx.header['frames'])
+                if idx.header['byteorder'] != sys.byteorder:
+                    column.byteswap()
+        if os.path.getsize(capture) != idx.header['size']:
+            print(f'warning: {capture} has changed size since it was indexed')
+        return idx
+
+    def read_from(self, offset):
+        """Yield the uncompressed contents of the capture, from offset onwards."""
+
+        if not self.capture.endswith('.gz'):
+            yield from read_chunks(self.capture, offset)
+            return
+
+        # start from the member containing offset, and throw away what comes before it
+        members = self.header['members']
+        comp, skip = members[bisect_right([u for _, u in members], offset) - 1] if members else (0, 0)
+        skip = offset - skip
+        with open(self.capture, 'rb') as f:
+            f.seek(comp)
+            for chunk in gunzip(f):
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+                yield chunk[skip:]
+                skip = 0
+
+    def replay_to(self, target, plant, snapshot):
+        """Bring plant and snapshot to the state just before frame number target."""
+
+        checkpoints = self.header['checkpoints']
+        i = bisect_right([c[0] for c in checkpoints], target) - 1
+        if i >= 0:
+            checkpoint, offset, last = checkpoints[i]
+            framer = ClientFramer()
+            for frame in last:
+                for message in framer.decode(bytes.fromhex(frame)):
+                    plant.update(message)
+                    snapshot.update(message)
+        else:
+            checkpoint, offset = 0, 0
+
+        # in a recording, the checkpoint may be part-way through the record at offset
+        n = self.frame_at(offset)
+        framer = ClientFramer()
+        # (from the very start, frames() needs to see the magic line of a recording)
+        for _, _, frame in frames(self.read_from(offset), self.header['records'] if offset else None):
+            if n >= target:
+                break
+            n += 1
+            if n <= checkpoint:
+                continue
+            try:
+                for message in framer.decode(frame):
+                    if isinstance(message, TransparentResponse):
+                        plant.update(message)
+                        snapshot.update(message)
+            except (ExceptionBase, NotImplementedError) as e:
+                print(e)
+
+    def frame_at(self, offset):
+        """Number of the first frame starting at or after offset."""
+        return bisect_right(self.offsets, offset - 1)
+
+    def frame_at_time(self, t):
+        """Number of the first frame received at or after time t."""
+        if not self.header['records']:
+            raise ValueError(f'{self.capture} is not a recording, so has no timestamps')
+        return bisect_right(self.times, t - 1e-6)
+
+    def touching(self, cls, reg, slave=None):
+        """Yield the numbers of the frames which carry a value for the register."""
+
+        functions = (READINPUT,) if cls == 'IR' else (READHOLDING, WRITEHOLDING)
+        for n, (s, f, b, c) in enumerate(zip(self.slaves, self.functions, self.bases, self.counts)):
+            if f in functions and b <= reg < b + c and (slave is None or s == slave):
+                yield n
+
+
+def parse_register(text):
+    m = re.fullmatch(r'(HR|IR)\(?(\d+)\)?', text.upper())
+    if m is None:
+        raise argparse.ArgumentTypeError(f'expected a register like HR(20), not {text}')
+    return m.group(1), int(m.group(2))
+
+def parse_time(text):
+    """Seconds since the epoch, or a local date and time, eg 2024-01-01T12:00:00"""
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+def load(capture, every):
+    """Load the index for a capture, building it first if it doesn't exist."""
+    if not os.path.exists(capture + '.idx'):
+        idx = Index.build(capture, every)
+        idx.write()
+        return idx
+    return Index.load(capture)
+
+def main(args):
+    if args.command == 'build':
+        for capture in args.captures:
+            idx = Index.build(capture, args.every)
+            idx.write()
+            print(f"{capture}: {idx.header['frames']} frames, {len(idx.header['checkpoints'])} checkpoints, "
+                  f"{len(idx.header['members'])} gzip members")
+
+    elif args.command == 'state':
+        idx = load(args.capture, args.every)
+        if args.frame is not None:
+            target = args.frame
+        elif args.offset is not None:
+            target = idx.frame_at(args.offset)
+        else:
+            try:
+                target = idx.frame_at_time(args.at)
+            except ValueError as e:
+                sys.exit(str(e))
+        plant = Plant()
+        snapshot = Snapshot()
+        idx.replay_to(target, plant, snapshot)
+        print(f'state before frame {target}')
+        if idx.header['records'] and target < len(idx.times):
+            print(f'received {datetime.datetime.fromtimestamp(idx.times[target])}')
+        if not args.reg:
+            show(plant)
+        for cls, reg in args.reg:
+            for (slave, rcls), regs in sorted(snapshot.registers.items(), key=lambda x: x[0][0]):
+                if rcls.__name__ == cls and reg in regs:
+                    print(f'{cls}({reg}) slave 0x{slave:02x}: {regs[reg]}')
+
+    elif args.command == 'touching':
+        idx = load(args.capture, args.every)
+        cls, reg = args.register
+        for n in idx.touching(cls, reg, args.slave):
+            print(f'frame {n} offset {idx.offsets[n]} slave 0x{idx.slaves[n]:02x} '
+                  f'base {idx.bases[n]} count {idx.counts[n]}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index capture files for quick seeking")
+    parser.add_argument('--every', type=int, default=10000, help="frames between checkpoints")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('build', help="(re)build the index for captures")
+    p.add_argument('captures', nargs='+')
+
+    p = sub.add_parser('state', help="show the state part-way through a capture")
+    p.add_argument('capture')
+    where = p.add_mutually_exclusive_group(required=True)
+    where.add_argument('--frame', type=int, help="state just before this frame number")
+    where.add_argument('--offset', type=int, help="state just before this offset in the (uncompressed) capture")
+    where.add_argument('--at', type=parse_time, help="state at this time (recordings only)")
+    p.add_argument('--reg', type=parse_register, action='append', default=[],
+                   help="just show this register, eg HR(20). Can be repeated.")
+
+    p = sub.add_parser('touching', help="list the frames carrying a register")
+    p.add_argument('capture')
+    p.add_argument('register', type=parse_register)
+    p.add_argument('--slave', type=lambda x: int(x, 0), help="only this slave address, eg 0x32")
+
+    main(parser.parse_args())
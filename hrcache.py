@@ -0,0 +1,141 @@
+"""
+On-disk cache of holding register values, so that scripts which just want
+to look at a setting don't have to ask the inverter every time.
+
+Each register's value is kept with the time it was last seen, so each
+reader can decide how old a value it is willing to accept. setreg.py
+keeps it up to date with what it reads and writes, and watch.py --hrcache
+with whatever holding registers go past.
+
+The inverter answers on several slave addresses (watch.py sees whatever
+the other clients ask for), so values are kept per host, whichever address
+they came from. Anything from a battery's address is ignored.
+
+The serial numbers of the inverter and dongle are kept as well, to go in
+the responses made up from the cache, as if they had come from the inverter.
+
+The file is json:
+  {"registers": {host: {register number: [value, time]}},
+   "serials": {host: [inverter serial, dongle serial]}}
+It is written to a temporary file and renamed into place, and merged with
+whatever is on disk at the time (keeping the newer value of each register),
+so several scripts can share it.
+"""
+
+import json
+import os
+import time
+
+from givenergy_modbus.pdu.transparent import ReadHoldingRegistersResponse
+
+DEFAULT_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'givenergy', 'hrcache.json')
+
+# the most registers the inverter will return in one read
+MAX_READ = 60
+
+# the inverter answers on any of these; higher ones are batteries
+INVERTER_SLAVES = (0x11, 0x30, 0x31, 0x32)
+
+# for made-up responses, if the cache hasn't seen the real serial numbers
+UNKNOWN_SERIAL = '??????????'
+
+
+class HRCache:
+    """Holding register values, with the time each was seen."""
+
+    def __init__(self, filename=DEFAULT_FILE):
+        self.filename = filename
+        self.hosts, self.serials = self._load()
+        self.dirty = False
+
+    def _load(self):
+        """Read the file, returning (hosts, serials)."""
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}, {}
+        # json keys are strings
+        return ({host: {int(reg): tuple(v) for reg, v in regs.items()} for host, regs in data['registers'].items()},
+                {host: tuple(v) for host, v in data['serials'].items()})
+
+    def update(self, host, response, when=None):
+        """Record the values in a holding register response seen from host."""
+        if response.slave_address not in INVERTER_SLAVES:
+            return
+        if when is None:
+            when = time.time()
+        regs = self.hosts.setdefault(host, {})
+        for reg, value in enumerate(response.register_values, response.base_register):
+            regs[reg] = (value, when)
+        self.serials[host] = (response.inverter_serial_number, response.data_adapter_serial_number)
+        self.dirty = True
+
+    def get(self, host, reg, max_age):
+        """The value of a register, if it was seen within the last max_age seconds. Else None."""
+        value, when = self.hosts.get(host, {}).get(reg, (None, 0))
+        if time.time() - when > max_age:
+            return None
+        return value
+
+    def responses(self, host, regs, max_age, slave):
+        """Make up ReadHoldingRegistersResponses, from slave, for those of regs which are fresh enough.
+
+        Returns (responses, registers which weren't fresh). The responses
+        can be fed to Plant.update() as if they had come from the inverter.
+        """
+
+        fresh = {}
+        stale = []
+        for reg in sorted(set(regs)):
+            value = self.get(host, reg, max_age)
+            if value is None:
+                stale.append(reg)
+            else:
+                fresh[reg] = value
+
+        inverter_serial, dongle_serial = self.serials.get(host, (UNKNOWN_SERIAL, UNKNOWN_SERIAL))
+
+        def response(base, values):
+            return ReadHoldingRegistersResponse(slave_address=slave, base_register=base,
+                                                register_count=len(values), register_values=values,
+                                                inverter_serial_number=inverter_serial,
+                                                data_adapter_serial_number=dongle_serial)
+
+        responses = []
+        base = None
+        values = []
+        for reg in fresh:
+            if base is not None and (reg != base + len(values) or len(values) == MAX_READ):
+                responses.append(response(base, values))
+                base = None
+            if base is None:
+                base = reg
+                values = []
+            values.append(fresh[reg])
+        if base is not None:
+            responses.append(response(base, values))
+        return responses, stale
+
+    def save(self):
+        """Write out the cache, merged with anyone else's changes since it was loaded."""
+
+        if not self.dirty:
+            return
+        merged, serials = self._load()
+        for host, regs in self.hosts.items():
+            theirs = merged.setdefault(host, {})
+            for reg, (value, when) in regs.items():
+                if reg not in theirs or theirs[reg][1] < when:
+                    theirs[reg] = (value, when)
+        serials.update(self.serials)
+        self.hosts = merged
+        self.serials = serials
+
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        tmp = f'{self.filename}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump({'registers': {host: {reg: list(v) for reg, v in regs.items()} for host, regs in merged.items()},
+                       'serials': {host: list(v) for host, v in serials.items()}}, f)
+        os.replace(tmp, self.filename)
+        self.dirty = False
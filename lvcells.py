@@ -4,29 +4,67 @@
 
 Note that this is low-voltage inverters only. AIO
 needs to use different registers.
+
+By default, does a (partial) refresh of the plant once a minute.
+With --fast SECS, reads just each battery's cell voltage block and the
+battery power register, which is light enough on the dongle to do every
+second or so. The requests for all the batteries go out together, rather
+than one after the other, so the readings are from as close to the same
+moment as possible. The samples are kept in a fixed-size ring buffer per
+battery, and each line also shows the imbalance between cells: now, and
+the worst over the last --window samples. Every --summary samples, the min
+and max of each cell over the window are shown as well.
+
+With --log PREFIX, the samples for battery n are also appended to PREFIX.n.bin:
+a magic line, then for each sample the time (little-endian double) followed
+by the WIDTH registers (little-endian uint16). read_log() reads one back.
 """
 
+import argparse
 import asyncio
 import logging
-import sys
+import struct
+import time
+from array import array
 from datetime import datetime
 
 from givenergy_modbus.client.client import Client
 from givenergy_modbus.model.plant import Plant
 from givenergy_modbus.model.register import IR
+from givenergy_modbus.pdu.transparent import ReadInputRegistersRequest
 
 _logger = logging.getLogger(__name__)
 
+# Battery registers, on the battery's slave address. IR(60) onwards
+# are the cell voltages in mV, and IR(100) is the state of charge.
+CELLS = 16
+CELL_BASE = 60
+SOC = 100
+
+# battery power, in W, is on the inverter
+P_BATTERY = 52
+
+# what is kept in the ring buffer for each sample: the cells, then soc, then battery power
+WIDTH = CELLS + 2
+
+# the first battery; the others follow
+BATTERY_SLAVE = 0x32
 
-async def cells():
+# the inverter answers on several addresses, but every model answers on this one
+INVERTER_SLAVE = 0x11
+
+LOG_MAGIC = b'LVCELLS1\n'
+LOG_RECORD = struct.Struct(f'<d{WIDTH}H')
+
+
+async def cells(args):
     """Connect to inverter and loop, displaying cell voltages."""
 
     # we only need the first page of inverter input registers (for
     # battery power), so don't bother doing a full detect.
-    # Also, assume exactly one battery.
     registers = {IR(0)}
-    plant = Plant(registers=registers, num_batteries=1)
-    client = Client(sys.argv[1], 8899, plant=plant)
+    plant = Plant(registers=registers, num_batteries=args.batteries)
+    client = Client(args.host, 8899, plant=plant)
     await client.connect()
 
     while True:
@@ -34,29 +72,155 @@ async def cells():
         await client.refresh_plant(full_refresh=False, retries=4)
 
         inverter = plant.inverter
-        batt = plant.batteries[0]
-        print(f"{now.hour:02d}:{now.minute:02d} {batt.soc:3d}% "
-              f"{inverter.p_battery:5d} "
-              f" {batt.v_cell_01:6.3f}"
-              f" {batt.v_cell_02:6.3f}"
-              f" {batt.v_cell_03:6.3f}"
-              f" {batt.v_cell_04:6.3f}"
-              f" {batt.v_cell_05:6.3f}"
-              f" {batt.v_cell_06:6.3f}"
-              f" {batt.v_cell_07:6.3f}"
-              f" {batt.v_cell_08:6.3f}"
-              f" {batt.v_cell_09:6.3f}"
-              f" {batt.v_cell_10:6.3f}"
-              f" {batt.v_cell_11:6.3f}"
-              f" {batt.v_cell_12:6.3f}"
-              f" {batt.v_cell_13:6.3f}"
-              f" {batt.v_cell_14:6.3f}"
-              f" {batt.v_cell_15:6.3f}"
-              f" {batt.v_cell_16:6.3f}"
-              )
+        for n, batt in enumerate(plant.batteries):
+            print(f"{now.hour:02d}:{now.minute:02d} {n} {batt.soc:3d}% "
+                  f"{inverter.p_battery:5d} "
+                  + ''.join(f" {getattr(batt, f'v_cell_{i:02d}'):6.3f}" for i in range(1, CELLS + 1)))
 
         await asyncio.sleep(60)
 
 
+class Ring:
+    """Fixed-size ring buffer of samples, each of which is width unsigned 16-bit values."""
+
+    def __init__(self, size, width):
+        self.size = size
+        self.width = width
+        self.data = array('H', bytes(2 * size * width))
+        self.times = array('d', bytes(8 * size))
+        self.count = 0    # samples added, ever
+
+    def add(self, t, values):
+        i = self.count % self.size
+        self.data[i * self.width:(i + 1) * self.width] = array('H', values)
+        self.times[i] = t
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def stats(self):
+        """Per-cell (min, max) over the samples held, and the worst imbalance between cells in any one sample.
+
+        Uses numpy if it's available, else plain python.
+        """
+
+        n = len(self)
+        try:
+            import numpy
+        except ImportError:
+            rows = [self.data[i * self.width:i * self.width + CELLS] for i in range(n)]
+            columns = list(zip(*rows))
+            return ([min(c) for c in columns], [max(c) for c in columns],
+                    max(max(r) - min(r) for r in rows))
+
+        # the order of the samples doesn't matter, so no need to unwrap the ring
+        cells = numpy.frombuffer(self.data, dtype=numpy.uint16).reshape(self.size, self.width)[:n, :CELLS]
+        return (cells.min(axis=0).tolist(), cells.max(axis=0).tolist(),
+                int((cells.max(axis=1) - cells.min(axis=1)).max()))
+
+
+async def fast_cells(args):
+    """Read just the registers needed, as often as asked."""
+
+    client = Client(args.host, 8899)
+    await client.connect()
+
+    # the battery power, and for each battery, the cells up to the soc in one request
+    requests = [ReadInputRegistersRequest(slave_address=INVERTER_SLAVE, base_register=P_BATTERY, register_count=1)]
+    requests += [
+        ReadInputRegistersRequest(slave_address=BATTERY_SLAVE + n, base_register=CELL_BASE,
+                                  register_count=SOC - CELL_BASE + 1)
+        for n in range(args.batteries)
+    ]
+    rings = [Ring(args.window, WIDTH) for _ in range(args.batteries)]
+    logs = [open_log(f'{args.log}.{n}.bin') if args.log else None for n in range(args.batteries)]
+
+    next_poll = time.monotonic()
+    while True:
+        now = time.time()
+        try:
+            # execute() sends them all without waiting for each response in turn
+            power, *batteries = await client.execute(requests, args.timeout, 2)
+        except Exception as e:
+            _logger.warning(f'{e!r}')
+        else:
+            for n, (ring, batt, log) in enumerate(zip(rings, batteries, logs)):
+                values = batt.register_values
+                sample = list(values[:CELLS]) + [values[SOC - CELL_BASE], power.register_values[0]]
+                ring.add(now, sample)
+                if log:
+                    log.write(LOG_RECORD.pack(now, *sample))
+                    log.flush()
+                show_sample(ring, now, n)
+            if args.summary and rings[0].count % args.summary == 0:
+                for n, ring in enumerate(rings):
+                    show_summary(ring, n)
+
+        # keep to the schedule, but if a poll took too long, don't try to catch up
+        next_poll = max(next_poll + args.fast, time.monotonic())
+        await asyncio.sleep(next_poll - time.monotonic())
+
+
+def open_log(filename):
+    f = open(filename, 'ab')
+    if f.tell() == 0:
+        f.write(LOG_MAGIC)
+    return f
+
+
+def read_log(filename):
+    """Read a --log file back, returning (times, samples): samples has WIDTH values per time."""
+
+    with open(filename, 'rb') as f:
+        if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError(f'{filename} is not an lvcells log')
+        data = f.read()
+    # ignore any partly written record at the end
+    data = data[:len(data) - len(data) % LOG_RECORD.size]
+    times = array('d')
+    samples = array('H')
+    for t, *values in LOG_RECORD.iter_unpack(data):
+        times.append(t)
+        samples.extend(values)
+    return times, samples
+
+
+def show_sample(ring, t, n):
+    i = (ring.count - 1) % ring.size
+    sample = ring.data[i * WIDTH:(i + 1) * WIDTH]
+    volts = sample[:CELLS]
+    soc = sample[CELLS]
+    power = sample[CELLS + 1]
+    if power >= 0x8000:
+        power -= 0x10000
+    _, _, worst = ring.stats()
+    print(f"{datetime.fromtimestamp(t):%H:%M:%S} {n} {soc:3d}% {power:5d} "
+          + ' '.join(f'{v / 1000:6.3f}' for v in volts)
+          + f"  imbalance {max(volts) - min(volts):3d}mV, worst {worst:3d}mV")
+
+
+def show_summary(ring, n):
+    lo, hi, worst = ring.stats()
+    span = ring.times[(ring.count - 1) % ring.size] - min(ring.times[:len(ring)])
+    print(f"battery {n}, over the last {len(ring)} samples ({span:.0f}s): worst imbalance {worst}mV")
+    print('  min ' + ' '.join(f'{v / 1000:6.3f}' for v in lo))
+    print('  max ' + ' '.join(f'{v / 1000:6.3f}' for v in hi))
+
+
 if __name__ == "__main__":
-    asyncio.run(cells())
+    parser = argparse.ArgumentParser(description="Display battery cell voltages")
+    parser.add_argument('host')
+    parser.add_argument('--fast', type=float, metavar='SECS',
+                        help="read just the cell voltages and battery power, every SECS (can be 1 or so)")
+    parser.add_argument('-b', '--batteries', type=int, default=1, help="number of batteries")
+    parser.add_argument('--log', metavar='PREFIX',
+                        help="with --fast, append the samples for battery n to PREFIX.n.bin")
+    parser.add_argument('--window', type=int, default=300, help="number of samples to keep, for --fast")
+    parser.add_argument('--summary', type=int, default=60,
+                        help="show per-cell min/max over the window every this many samples (0 for never)")
+    parser.add_argument('--timeout', type=float, default=2.0, help="seconds to wait for each response")
+    args = parser.parse_args()
+    if args.log and not args.fast:
+        parser.error("--log only works with --fast")
+    asyncio.run(fast_cells(args) if args.fast else cells(args))
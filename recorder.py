@@ -0,0 +1,258 @@
+"""
+Record traffic to a file, without slowing down whoever is receiving it.
+
+A Recorder can be passed as Client(recorder=...) in place of a plain file:
+write() just timestamps the data and puts it on a queue, and a background
+thread does the compression and the disk writes. If the thread falls behind
+and the queue fills up, data is dropped (and counted) rather than stalling
+the event loop or growing without limit.
+
+The file format is a magic line, followed by records, each of which is
+the time the data was received (a little-endian double, as from time.time())
+and the length of the data (little-endian uint32), then the data itself:
+whatever came off the socket, so frames may be split across records.
+replay2.py reads these as well as plain socat captures.
+
+If the filename ends in .gz, each batch of records written is a separate
+gzip member, so the file is still a valid gzip file, but capindex.py can
+start decompressing part-way through. Files can be rotated by size or age,
+in which case a timestamp and sequence number are added to the name of each
+one, so that they sort in order. The frames are followed through the data,
+so that a file always ends where a frame does: if the data at the time of
+a rotation ends part-way through a frame, that record is split in two, and
+the rest of it starts the next file.
+
+If writing fails (say the disk is full), the error is logged and recording
+stops; anything written after that is counted as dropped.
+"""
+
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+
+# python-isal is a drop-in replacement for zlib, but a few times faster
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
+
+_logger = logging.getLogger(__name__)
+
+MAGIC = b'GIVREC1\n'
+
+# start of every frame, followed by a big-endian length of up to 300
+HEADER = bytes.fromhex('59590001')
+
+# timestamp, length
+RECORD = struct.Struct('<dI')
+
+# write out once this much is waiting...
+FLUSH_SIZE = 256 * 1024
+
+
+class Recorder:
+    """File-like object which records timestamped data in a background thread."""
+
+    def __init__(self, filename, rotate_size=0, rotate_time=0, flush_interval=5.0, queue_size=10000,
+                 compresslevel=6):
+        self.filename = filename
+        self.rotate_size = rotate_size         # bytes written to a file before starting another (0 for never)
+        self.rotate_time = rotate_time         # seconds before starting another file (0 for never)
+        self.flush_interval = flush_interval   # ... or after this long
+        self.compresslevel = compresslevel
+        self.dropped = 0        # writes discarded because the queue was full
+        self.dropped_bytes = 0
+        self.failed = False     # writing failed, so recording has stopped
+
+        self._queue = queue.Queue(queue_size)
+        self._file = None
+        self._frame_left = 0    # bytes of the current frame still to come
+        self._header = b''      # what has been seen of the next frame's header
+        self._size = 0          # bytes written to the current file
+        self._opened = 0.0      # when the current file was opened
+        self._thread = threading.Thread(target=self._run, name=f'recorder {filename}', daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        """Queue data to be recorded. Never blocks."""
+        try:
+            if not self._thread.is_alive():
+                # writing failed, and recording has stopped
+                raise queue.Full
+            self._queue.put_nowait((time.time(), bytes(data)))
+        except queue.Full:
+            self.dropped += 1
+            self.dropped_bytes += len(data)
+
+    def flush(self):
+        # the thread flushes by itself often enough
+        pass
+
+    def close(self):
+        """Write out everything queued so far, and stop."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self.failed:
+            _logger.warning(f'{self.filename}: recording stopped early')
+        if self.dropped:
+            _logger.warning(f'{self.filename}: dropped {self.dropped} writes ({self.dropped_bytes} bytes)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _next_filename(self):
+        if not (self.rotate_size or self.rotate_time):
+            return self.filename
+        # capture.rec.gz -> capture-20240101T120000-000.rec.gz
+        # The sequence number is for more than one in a second. It is always
+        # there, and fixed width, so the names sort in the order they were made.
+        head, tail = os.path.split(self.filename)
+        root, dot, ext = tail.partition('.')
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        n = 0
+        while os.path.exists(name := os.path.join(head, f"{root}-{stamp}-{n:03d}{dot}{ext}")):
+            n += 1
+        return name
+
+    def _frame_end(self, data):
+        """Follow the frames through the next piece of data.
+
+        Returns the offset in data just after the last frame which ends in it,
+        or None if none does.
+        """
+
+        last = None
+        pos = 0
+        while pos < len(data):
+            if self._frame_left:
+                n = min(self._frame_left, len(data) - pos)
+                pos += n
+                self._frame_left -= n
+                if not self._frame_left:
+                    last = pos
+                continue
+            more = data[pos:pos + 6 - len(self._header)]
+            self._header += more
+            pos += len(more)
+            if len(self._header) < 6:
+                break
+            length = int.from_bytes(self._header[4:6], 'big')
+            if self._header[:4] == HEADER and length <= 300:
+                self._frame_left = length
+                self._header = b''
+                if not length:
+                    last = pos
+            else:
+                # not a frame header - skip a byte and look again
+                self._header = self._header[1:]
+        return last
+
+    def _write(self, records, cut):
+        """Write a batch of (timestamp, data) records to the file, starting a new file if it's time to.
+
+        cut is (record, offset) of the last frame boundary in the batch, or None.
+        If a new file is due, the batch is split there, so no frame is split
+        between files.
+        """
+
+        if self._file is not None and (
+                (self.rotate_size and self._size >= self.rotate_size)
+                or (self.rotate_time and time.monotonic() - self._opened >= self.rotate_time)):
+            if cut is not None:
+                i, offset = cut
+                timestamp, data = records[i]
+                self._append(records[:i] + [(timestamp, data[:offset])])
+                records = [(timestamp, data[offset:])] + records[i + 1:]
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            name = self._next_filename()
+            _logger.info(f'recording to {name}')
+            self._file = open(name, 'wb')
+            self._size = 0
+            self._opened = time.monotonic()
+            self._append(records, MAGIC)
+        else:
+            self._append(records)
+
+    def _append(self, records, buf=b''):
+        """Write records to the current file, after buf."""
+
+        buf = bytearray(buf)
+        for timestamp, data in records:
+            if data:
+                buf += RECORD.pack(timestamp, len(data))
+                buf += data
+        if not buf:
+            return
+        if self.filename.endswith('.gz'):
+            c = zlib.compressobj(self.compresslevel, zlib.DEFLATED, 31)
+            buf = c.compress(buf) + c.flush()
+        self._file.write(buf)
+        self._file.flush()
+        self._size += len(buf)
+
+    def _run(self):
+        records = []
+        size = 0
+        cut = None
+        last = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if item:
+                    offset = self._frame_end(item[1])
+                    if offset is not None:
+                        cut = (len(records), offset)
+                    records.append(item)
+                    size += RECORD.size + len(item[1])
+                now = time.monotonic()
+                if size >= FLUSH_SIZE or (records and now - last >= self.flush_interval):
+                    self._write(records, cut)
+                    records = []
+                    size = 0
+                    cut = None
+                    last = now
+            if records:
+                self._write(records, cut)
+        except Exception:
+            self.failed = True
+            _logger.exception(f'{self.filename}: recording failed')
+        finally:
+            if self._file is not None:
+                self._file.close()
+
+
+def split_records(chunks):
+    """Undo the recording: yields (offset in stream, timestamp, data) for each record.
+
+    chunks is the uncompressed contents of a recording, after the magic line.
+    offset is of the start of the record, counting from the start of chunks.
+    """
+
+    buf = b''
+    base = 0   # stream offset of buf[0]
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while pos + RECORD.size <= len(buf):
+            timestamp, length = RECORD.unpack_from(buf, pos)
+            end = pos + RECORD.size + length
+            if end > len(buf):
+                break
+            yield base + pos, timestamp, buf[pos + RECORD.size:end]
+            pos = end
+        base += pos
+        buf = buf[pos:]
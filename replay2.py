@@ -9,9 +9,17 @@
 #   socat -x -r binfile TCP-LISTEN:8899 TCP:host:8899   # in the middle
 #   socat -x -u TCP:host:8899 CREATE:binfile            # spy
 
-import gzip
+import argparse
+import json
 import logging
+import mmap
+import os
 import sys
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 
 from givenergy_modbus.exceptions import ExceptionBase
 from givenergy_modbus.pdu.framer import ClientFramer
@@ -20,6 +28,11 @@ from givenergy_modbus.model.plant import Plant
 from givenergy_modbus.model.inverter import Inverter
 from givenergy_modbus.pdu import TransparentResponse, HeartbeatRequest
 from givenergy_modbus.model.register import HR, IR
+from givenergy_modbus.pdu.transparent import READINPUT, READHOLDING, WRITEHOLDING
+
+from server import RegisterBlock, write_snapshot
+# (zlib from recorder is python-isal's, if that's installed)
+from recorder import HEADER, MAGIC, split_records, zlib
 
 _logger = logging.getLogger(__name__)
 
@@ -27,45 +40,540 @@ class MyPlant(Plant):
     def registers_updated(self, reg, count, values):
         print(reg, count)
 
-def replay():
-    """Read modbus frames from a file"""
 
-    plant = MyPlant()
+# Reading captures.
+# Files are read in big chunks: plain files via mmap, and .gz files are
+# decompressed with zlib directly rather than through GzipFile. The framer
+# copies its whole buffer every time it takes a frame off the front, so
+# handing it a big chunk at once would be quadratic. So split_frames()
+# does the cheap part - finding where each frame starts and ends - and
+# the framer only ever gets one frame at a time.
+#
+# A capture can also be a recording from recorder.py (eg from watch.py),
+# where the traffic is wrapped up in timestamped records. frames() copes
+# with either.
+
+CHUNK = 256 * 1024
+
+def tail(f, interval):
+    """Yield data from file f, and then whatever is appended to it, polling every interval seconds.
+
+    Never finishes: the caller stops when it has had enough.
+    """
+
+    while True:
+        data = f.read(CHUNK)
+        if data:
+            yield data
+        else:
+            time.sleep(interval)
+
+def gunzip(f, members=None, follow=0):
+    """Decompress gzip data from the current position of file f, yielding chunks.
+
+    There may be several gzip members concatenated. If members is a list,
+    (compressed offset, uncompressed offset) of the start of each member
+    is appended to it, relative to where we started. If follow is nonzero,
+    carry on decompressing whatever is appended to the file - see tail().
+    """
+
+    d = zlib.decompressobj(wbits=31)
+    pending = False  # in the middle of a gzip member
+    fed = 0          # compressed bytes read
+    produced = 0     # uncompressed bytes yielded
+    for data in tail(f, follow) if follow else iter(lambda: f.read(CHUNK), b''):
+        fed += len(data)
+        while data:
+            if not pending and members is not None:
+                members.append((fed - len(data), produced))
+            pending = True
+            out = d.decompress(data)
+            produced += len(out)
+            yield out
+            data = b''
+            if d.eof:
+                data = d.unused_data
+                d = zlib.decompressobj(wbits=31)
+                pending = False
+    if pending:
+        print(f'{f.name}: compressed data ends part-way through')
 
-    for file in sys.argv[1:]:
-        framer = ClientFramer()
+def read_chunks(file, start=0, end=None, members=None, follow=0):
+    """Yield the (uncompressed) contents of a capture file in large chunks.
+
+    For plain files, can ask for just the part from start to end.
+    For .gz files, members is passed on to gunzip().
+    If follow is nonzero, keep going as the file grows - see tail().
+    """
+
+    with open(file, 'rb') as f:
         if file.endswith('.gz'):
-            log = gzip.GzipFile(file, "rb")
+            yield from gunzip(f, members, follow)
+        elif follow:
+            f.seek(start)
+            yield from tail(f, follow)
+        else:
+            size = os.fstat(f.fileno()).st_size
+            if end is None or end > size:
+                end = size
+            if start >= end:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                for offs in range(start, end, CHUNK):
+                    yield m[offs:min(offs + CHUNK, end)]
+
+def split_frames(chunks):
+    """Cut a stream of chunks into frames. Yields (offset in stream, frame)."""
+
+    buf = b''
+    base = 0   # stream offset of buf[0]
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while (start := buf.find(HEADER, pos)) >= 0 and start + 6 <= len(buf):
+            length = int.from_bytes(buf[start + 4:start + 6], 'big')
+            if length > 300:
+                # not really a frame header - keep looking
+                pos = start + 4
+                continue
+            end = start + 6 + length
+            if end > len(buf):
+                pos = start
+                break
+            yield base + start, buf[start:end]
+            pos = end
         else:
-            log = open(file, mode='rb')
+            # keep anything which might be the start of a header
+            if start < 0:
+                pos = max(pos, len(buf) - len(HEADER) + 1)
+        base += pos
+        buf = buf[pos:]
+
+def frames(chunks, records=None):
+    """Cut the contents of a capture into frames. Yields (offset, timestamp, frame).
+
+    For a plain capture, the timestamp is None. For a recording, the offset is
+    of the record in which the frame starts - somewhere reading could be started
+    again from - and the timestamp is of the record in which it ends. records says
+    whether chunks is a recording, or if None, that is worked out from the magic
+    line at the start.
+    """
+
+    chunks = iter(chunks)
+    base = 0
+    if records is None:
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= len(MAGIC):
+                break
+        records = head.startswith(MAGIC)
+        if records:
+            base = len(MAGIC)
+            head = head[base:]
+        chunks = chain([head], chunks)
+
+    if not records:
+        for offset, frame in split_frames(chunks):
+            yield offset, None, frame
+        return
+
+    index = deque()   # (offset in the unwrapped data, offset, timestamp) of the records we're in the middle of
+
+    def unwrap():
+        pos = 0
+        for offset, timestamp, data in split_records(chunks):
+            index.append((pos, base + offset, timestamp))
+            pos += len(data)
+            yield data
+
+    for pos, frame in split_frames(unwrap()):
+        while len(index) > 1 and index[1][0] <= pos:
+            index.popleft()
+        end = pos + len(frame)
+        timestamp = index[0][2]
+        for start, _, t in index:
+            if start >= end:
+                break
+            timestamp = t
+        yield index[0][1], timestamp, frame
+
+def is_recording(file):
+    """Whether file is a recording from recorder.py, rather than a plain capture."""
+    head = b''
+    chunks = read_chunks(file)
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(MAGIC):
+            break
+    chunks.close()
+    return head.startswith(MAGIC)
+
+def messages(file, follow=0):
+    """Decode a capture file, yielding (offset, timestamp, message) for each frame.
+
+    The message may be an exception, for a frame which couldn't be decoded.
+    If follow is nonzero, carry on with frames as they are appended to the file.
+    """
+
+    framer = ClientFramer()
+    for offset, timestamp, frame in frames(read_chunks(file, follow=follow)):
         try:
-            while len(frame := log.read(300)) > 0:
-                try:
-                    for message in framer.decode(frame):
+            for message in framer.decode(frame):
+                yield offset, timestamp, message
+        except (ExceptionBase, NotImplementedError) as e:
+            yield offset, timestamp, e
+
+# Parallel replay.
+# Each file - or for plain files, each segment of a file - is decoded in
+# a separate process. It is boiled down to just the last response of each
+# shape (same message type, slave, base register and count), in order of
+# last appearance. Applying those to the plant, segment by segment, leaves
+# it in the same state as replaying every frame would. Workers send back
+# the raw frames, which are much cheaper to pickle than decoded messages.
+# A worker finds its first frame by looking for a header, which can be
+# fooled by something that looks like one in the tail of the previous
+# segment's last frame. So each segment has to start exactly where the
+# previous one's last frame ended, and any that doesn't is decoded again,
+# serially, from there.
+
+# plain captures are cut into segments of at least this size. Recordings
+# can't be: a segment has to start at the start of a record.
+SEGMENT = 16 * 1024 * 1024
+
+# longest possible frame: 6 byte header plus up to 300
+MAX_FRAME = 306
+
+def segments(files, jobs):
+    """Divide the files up into (file, start, end) pieces of work, in order."""
+
+    work = []
+    for file in files:
+        size = 0 if file.endswith('.gz') or is_recording(file) else os.path.getsize(file)
+        n = max(1, min(jobs, size // SEGMENT))
+        step = -(-size // n)
+        for i in range(n):
+            work.append((file, i * step, None if i == n - 1 else (i + 1) * step))
+    return work
+
+def reduce_segment(file, start, end):
+    """Worker: decode one piece of a capture.
+
+    Returns (last frame of each shape, frames, errors, first, stop): first is
+    the file offset of the first frame (None if there weren't any), and stop
+    is where the last one ended (start if there weren't any).
+
+    The piece includes the frames which start between start and end. Except
+    at the very beginning of the file, start is probably in the middle of a
+    frame. That frame belongs to the previous segment, and split_frames()
+    skips its tail while looking for a header.
+    """
+
+    framer = ClientFramer()
+    last = {}
+    n = errors = 0
+    first = None
+    stop = start
+    chunks = read_chunks(file, start, None if end is None else end + MAX_FRAME)
+    for offset, _, frame in frames(chunks):
+        if end is not None and start + offset >= end:
+            break
+        n += 1
+        if first is None:
+            first = start + offset
+        stop = start + offset + len(frame)
+        try:
+            for message in framer.decode(frame):
+                if isinstance(message, TransparentResponse) and not message.error:
+                    key = (type(message), message.slave_address, message.base_register, message.register_count)
+                    last.pop(key, None)
+                    last[key] = frame
+        except (ExceptionBase, NotImplementedError):
+            errors += 1
+    return list(last.values()), n, errors, first, stop
+
+def replay_parallel(args):
+    """Like replay(), but decoding the files in a pool of processes."""
+
+    plant = Plant() if args.quiet else MyPlant()
+    snapshot = Snapshot() if args.snapshot else None
+    frames = errors = redone = 0
+    start = time.perf_counter()
+
+    work = segments(args.files, args.jobs)
+    with ProcessPoolExecutor(args.jobs) as pool:
+        # map() hands back the results in order
+        stop = 0
+        for (file, seg_start, seg_end), (last, n, e, first, seg_stop) in zip(
+                work, pool.map(reduce_segment, *zip(*work))):
+            if seg_start and first != stop:
+                # the worker didn't pick up where the previous segment left off
+                redone += 1
+                last, n, e, first, seg_stop = reduce_segment(file, stop, seg_end)
+            stop = seg_stop
+            frames += n
+            errors += e
+            framer = ClientFramer()
+            for frame in last:
+                for message in framer.decode(frame):
+                    plant.update(message)
+                    if snapshot:
+                        snapshot.update(message)
+
+    if not args.quiet:
+        show(plant)
+
+    elapsed = time.perf_counter() - start
+    redone = f', {redone} segments decoded again' if redone else ''
+    print(f"{frames} frames ({errors} errors{redone}) in {elapsed:.2f}s: {frames / elapsed:.0f} frames/s")
+
+    if snapshot:
+        snapshot.write(args.snapshot, ' '.join(args.files))
+
+class Snapshot:
+    """Remember the last value seen for every register, to write out as a server.py personality."""
+
+    def __init__(self):
+        self.registers = {}   # (slave address, register class) -> {register number: value}
+        self.inverter_serial = None
+        self.dongle_serial = None
+
+    def update(self, message):
+        # a write response carries the new value of the register; nothing else describes registers
+        if message.error:
+            return
+        if message.transparent_function_code == READINPUT:
+            cls = IR
+        elif message.transparent_function_code in (READHOLDING, WRITEHOLDING):
+            cls = HR
+        else:
+            return
+        regs = self.registers.setdefault((message.slave_address, cls), {})
+        for i, val in enumerate(message.register_values):
+            regs[message.base_register + i] = val
+        self.inverter_serial = message.inverter_serial_number
+        self.dongle_serial = message.data_adapter_serial_number
+
+    def blocks(self):
+        """Turn the registers into a list of RegisterBlocks.
+
+        Each contiguous run of registers seen for a slave address becomes a block,
+        and then identical blocks for different slave addresses are merged.
+        """
+
+        runs = {}  # (register class, base, values) -> [slave addresses]
+        for (slave, cls), regs in sorted(self.registers.items(), key=lambda x: (x[0][0], x[0][1].__name__)):
+            base = None
+            values = []
+            for reg in sorted(regs):
+                if base is not None and reg != base + len(values):
+                    runs.setdefault((cls, base, tuple(values)), []).append(slave)
+                    base = None
+                if base is None:
+                    base = reg
+                    values = []
+                values.append(regs[reg])
+            if base is not None:
+                runs.setdefault((cls, base, tuple(values)), []).append(slave)
+
+        return [RegisterBlock(slaves, cls(base), values) for (cls, base, values), slaves in runs.items()]
+
+    def write(self, filename, description):
+        write_snapshot(filename, self.blocks(), description=description,
+                       inverter_serial=self.inverter_serial, dongle_serial=self.dongle_serial)
+
+# Export of register history.
+# Each register (per slave address and register class) becomes a column,
+# stored as change points: the frame numbers at which its value changed,
+# and the new values. Most registers hardly ever change, so this is far
+# smaller than a value for every frame, and it is easy to expand back out
+# to a value at any frame with numpy.searchsorted().
+#
+# File layout:
+#   magic b'REGCOLS1\n'
+#   4 byte little-endian length, then that many bytes of json header
+#   then for each column in the header, its frame numbers (uint32) and
+#   its values (uint16), in the byte order noted in the header.
+#   then if the capture was a recording, the time of every frame (double)
+
+EXPORT_MAGIC = b'REGCOLS1\n'
+
+class Export:
+    """Record the history of every register, to write out as columns."""
+
+    # a write response carries the new value of the register; nothing else describes registers
+    classes = {READINPUT: 'IR', READHOLDING: 'HR', WRITEHOLDING: 'HR'}
+
+    def __init__(self):
+        self.columns = {}   # (slave address, 'HR'/'IR', register number) -> (frames, values)
+        self.times = array('d')   # receive time of every frame, or 0 if not known
+
+    def update(self, n, message):
+        """Record the register values in message, which arrived in frame number n."""
+        cls = self.classes.get(message.transparent_function_code)
+        if cls is None or message.error:
+            return
+        columns = self.columns
+        for reg, val in enumerate(message.register_values, message.base_register):
+            key = (message.slave_address, cls, reg)
+            col = columns.get(key)
+            if col is None:
+                col = columns[key] = (array('I'), array('H'))
+            elif col[1][-1] == val:
+                continue
+            col[0].append(n)
+            col[1].append(val)
+
+    def write(self, filename, description, frames):
+        keys = sorted(self.columns)
+        header = json.dumps({
+            'description': description,
+            'frames': frames,
+            'byteorder': sys.byteorder,
+            'times': any(self.times),
+            'columns': [[slave, cls, reg, len(self.columns[slave, cls, reg][0])] for slave, cls, reg in keys],
+        }).encode()
+        with open(filename, 'wb') as f:
+            f.write(EXPORT_MAGIC)
+            f.write(len(header).to_bytes(4, 'little'))
+            f.write(header)
+            for key in keys:
+                frames, values = self.columns[key]
+                frames.tofile(f)
+                values.tofile(f)
+            if any(self.times):
+                self.times.tofile(f)
+
+def load_export(filename):
+    """Read a file written by --export.
+
+    Returns (header, columns, times), where columns maps (slave address, 'HR'/'IR', register)
+    to (frame numbers, values). They are numpy arrays if numpy is available, so
+    to get the value of a register at a set of frames:
+      i = numpy.searchsorted(frames, at, side='right') - 1
+      values[i]    # where i >= 0: before that, the register hadn't been seen
+    times is the time each frame was received, or None if the capture wasn't
+    a recording with timestamps.
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    with open(filename, 'rb') as f:
+        if f.read(len(EXPORT_MAGIC)) != EXPORT_MAGIC:
+            raise ValueError(f'{filename} is not a register export')
+        length = int.from_bytes(f.read(4), 'little')
+        header = json.loads(f.read(length))
+        data = f.read()
+
+    columns = {}
+    order = '<' if header['byteorder'] == 'little' else '>'
+    offs = 0
+    for slave, cls, reg, n in header['columns']:
+        if numpy is not None:
+            frames = numpy.frombuffer(data, order + 'u4', n, offs)
+            values = numpy.frombuffer(data, order + 'u2', n, offs + 4 * n)
+        else:
+            frames = array('I', data[offs:offs + 4 * n])
+            values = array('H', data[offs + 4 * n:offs + 6 * n])
+            if header['byteorder'] != sys.byteorder:
+                frames.byteswap()
+                values.byteswap()
+        offs += 6 * n
+        columns[slave, cls, reg] = (frames, values)
+
+    times = None
+    if header.get('times'):
+        if numpy is not None:
+            times = numpy.frombuffer(data, order + 'f8', header['frames'], offs)
+        else:
+            times = array('d', data[offs:offs + 8 * header['frames']])
+            if header['byteorder'] != sys.byteorder:
+                times.byteswap()
+    return header, columns, times
+
+def show(plant):
+    # plant.detect_batteries()
+    # Now iterate over all inverter registers, showing last known state
+    inv = plant.inverter
+    x = inv.get('i_battery')
+    for reg, val in inv.getall():
+        print(reg, val)
+
+def replay(args):
+    """Read modbus frames from a file"""
+
+    # in quiet mode, don't want MyPlant's output either
+    plant = Plant() if args.quiet else MyPlant()
+    snapshot = Snapshot() if args.snapshot else None
+    export = Export() if args.export else None
+    frames = errors = 0
+    start = time.perf_counter()
+
+    for file in args.files:
+        # only the last file is followed: the earlier ones are presumably finished
+        follow = args.follow if file is args.files[-1] else 0
+        try:
+            for offset, timestamp, message in messages(file, follow):
+                frames += 1
+                if export:
+                    export.times.append(timestamp or 0.0)
+                if isinstance(message, Exception):
+                    errors += 1
+                    if not args.quiet:
                         print(message)
-                        if isinstance(message, HeartbeatRequest):
-                            pass
-                        if isinstance(message, TransparentResponse):
-                            #before = message.check
-                            #encoded = message.encode()
-                            #after = message.check
-                            #print(f"{before:04x} -- {after:04x}")
-                            plant.update(message)
-                except (ExceptionBase, NotImplementedError) as e:
-                    print(e)
-        except EOFError as e:  # can happen if reading incomplete gzip files
-            print(e)
-        log.close()
-
-        # plant.detect_batteries()
-        # Now iterate over all inverter registers, showing last known state
-        inv = plant.inverter
-        x = inv.get('i_battery')
-        for reg, val in inv.getall():
-            print(reg, val)
+                    continue
+                if not args.quiet:
+                    print(message)
+                if isinstance(message, HeartbeatRequest):
+                    pass
+                if isinstance(message, TransparentResponse):
+                    #before = message.check
+                    #encoded = message.encode()
+                    #after = message.check
+                    #print(f"{before:04x} -- {after:04x}")
+                    plant.update(message)
+                    if snapshot:
+                        snapshot.update(message)
+                    if export:
+                        export.update(frames - 1, message)
+        except KeyboardInterrupt:
+            # the way to stop following
+            if not follow:
+                raise
+
+        if not args.quiet:
+            show(plant)
+
+    elapsed = time.perf_counter() - start
+    print(f"{frames} frames ({errors} errors) in {elapsed:.2f}s: {frames / elapsed:.0f} frames/s")
+
+    if snapshot:
+        snapshot.write(args.snapshot, ' '.join(args.files))
+    if export:
+        export.write(args.export, ' '.join(args.files), frames)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    if len(sys.argv) < 2:
-        print("Usage: replay2.py binfile ...")
-    replay()
+    parser = argparse.ArgumentParser(description="Replay captured modbus traffic through a plant")
+    parser.add_argument('files', metavar='binfile', nargs='+')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="don't print each message, just replay them and report the rate")
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help="write the last known register values as a server.py personality")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="decode files (or segments of big uncompressed files) in this many processes")
+    parser.add_argument('--export', metavar='FILE',
+                        help="write the history of every register, as columns (see load_export())")
+    parser.add_argument('-f', '--follow', metavar='SECS', type=float, nargs='?', const=0.5, default=0,
+                        help="like tail -f: after the end of the last file, keep decoding frames as they "
+                             "are appended, checking every SECS (default 0.5). Stop with ^C")
+    args = parser.parse_args()
+    if args.jobs > 1 and (args.export or args.follow):
+        parser.error("--export and --follow need every frame in order, so can't be used with --jobs")
+    if args.jobs > 1:
+        replay_parallel(args)
+    else:
+        replay(args)
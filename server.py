@@ -1,31 +1,69 @@
 """
 A very crude modbus server which might give the appearance of
 being an inverter to client scripts. Can be given different
-register snapshots to give it different personalities.
-
-Should support concurrent connections - not something I need,
-but basically falls out free. Note that it does *not* send
-responses to all connected clients, only the one that made
-the request.
+register snapshots to give it different personalities:
+
+  python server.py                  # built-in HybridG3
+  python server.py snapshot.json    # from a snapshot file (see below)
+  python server.py -n 100           # 100 inverters, on ports 8899-8998
+
+When emulating a fleet, each inverter is a clone of the same plant with
+its own serial numbers. They share register blocks until one of them
+writes to a block, at which point it gets its own copy, so each extra
+inverter costs very little. They all run in the one event loop.
+
+To use more than one core, --workers N forks N processes which all
+listen on the same port(s). The holding registers are moved into shared
+memory first, so a write through one worker is seen by all of them.
+
+Built on asyncio, so concurrent connections come for free. Each
+connection gets its own InverterEmulator protocol instance. Responses
+are handed to the transport, which buffers anything the socket
+can't take straight away. If a client stops reading its responses and
+that buffer grows past the high-water mark, we stop reading requests
+from it until it has caught up.
+
+By default, responses only go to the client that made the request.
+The real dongle sends every response to all connected clients, which
+passive watchers like watch.py rely on: --broadcast does that too. Each
+response is encoded once and the same bytes are written to every
+connection to that inverter. A connection whose output is already more
+than BROADCAST_LIMIT bytes behind either misses the frame (--broadcast=drop,
+the default) or gets disconnected (--broadcast=disconnect), so a slow
+watcher can't hold anyone else up. Note that with --workers, a response
+only reaches the connections handled by the same worker process.
 
 Changes to holding registers should persist while the script runs,
 but will not be preserved between runs - each launch will start from
 the clean state.
 
-Does not implement heartbeat requests. I don't need that, but
-if someone was implementing a brand new client from scratch,
-it might be useful to add that. Shouldn't be hard - just
-a time-limit stored in each InverterEmulator instance (one
-per connection), and then the main loop can check whether
-any of the connections need to be tested.
+With --heartbeat SECS, sends each client a heartbeat request every
+SECS seconds (the dongle uses 180), which the client has to answer within
+HEARTBEAT_TIMEOUT seconds, or before the next one if that's sooner.
+After HEARTBEAT_MISSES unanswered heartbeats in a row, the connection is
+dropped, as the dongle does. Each connection has just one pending timer
+at a time, held in the event loop's timer heap. So idle connections cost
+nothing until their own timer comes due, and nothing ever scans all of
+them.
 """
 
-import selectors
-import socket
-
+import argparse
+import asyncio
+import contextlib
+import copy
+import json
+import multiprocessing
+import signal
+import sys
+import time
+
+from array import array
+from bisect import bisect_right
+from multiprocessing.shared_memory import SharedMemory
 from typing import ClassVar, Sequence
 
 from givenergy_modbus.model.register import Register, HR, IR
+from givenergy_modbus.pdu import HeartbeatRequest, HeartbeatResponse
 from givenergy_modbus.pdu.framer import ServerFramer
 from givenergy_modbus.pdu.transparent import (
     READINPUT,
@@ -44,9 +82,125 @@ from givenergy_modbus.pdu.transparent import (
 DONGLE_SERIAL='WH1234G567'
 INVERTER_SERIAL='FD9876G543'
 
+# Per-connection limits on the transport's output buffer: if more than
+# HIGH_WATER bytes of responses are waiting to be sent, stop reading
+# requests from that client until it drains down to LOW_WATER.
+HIGH_WATER = 64 * 1024
+LOW_WATER = 16 * 1024
+
+# In broadcast mode, a connection with more than this many bytes
+# waiting to be sent doesn't get any more broadcast frames.
+BROADCAST_LIMIT = 256 * 1024
+
+# A client has to answer a heartbeat request within HEARTBEAT_TIMEOUT
+# seconds, and is disconnected after HEARTBEAT_MISSES misses in a row.
+HEARTBEAT_TIMEOUT = 5.0
+HEARTBEAT_MISSES = 3
+
+# Limit on number of encoded responses cached by each plant.
+CACHE_LIMIT = 1024
+
+
+# Printing every request soon becomes the bottleneck under load. So
+# instead there are counters and histograms, which can be dumped
+# periodically (--stats SECS), and per-request tracing goes through a
+# rate limiter (--trace N lines per second).
+
+class Histogram:
+    """Log2-bucketed histogram of non-negative integers."""
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[int(value).bit_length()] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p'th percentile."""
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return (1 << i) - 1
+        return 0
+
+    def __str__(self):
+        if not self.count:
+            return "-"
+        return (f"p50 <={self.percentile(50)} p95 <={self.percentile(95)} "
+                f"p99 <={self.percentile(99)} max {self.max}")
+
+class Stats:
+    """Counters and histograms for the current stats interval."""
+
+    names = {READINPUT: 'IR', READHOLDING: 'HR', WRITEHOLDING: 'W'}
+
+    def __init__(self):
+        self.reset()
+        self.connections = 0
+
+    def reset(self):
+        self.start = time.monotonic()
+        self.requests = dict.fromkeys([*self.names.values(), 'other'], 0)
+        self.heartbeats = 0
+        self.unknown = 0        # requests for registers we don't have
+        self.cache_hits = 0
+        self.decode = Histogram()    # us per chunk of data received, excluding respond
+        self.respond = Histogram()   # us per request
+        self.queue = Histogram()     # bytes waiting to be sent, after each write
+
+    def dump(self):
+        elapsed = time.monotonic() - self.start
+        total = sum(self.requests.values())
+        reqs = ' '.join(f'{name} {n}' for name, n in self.requests.items())
+        hit = f'{100 * self.cache_hits / total:.0f}%' if total else '-'
+        print(f'stats: {total} req ({total / elapsed:.1f}/s) {reqs} HB {self.heartbeats} '
+              f'unknown {self.unknown} cache hit {hit} conns {self.connections}')
+        print(f'  decode us {self.decode}')
+        print(f'  respond us {self.respond}')
+        print(f'  queue bytes {self.queue}')
+        self.reset()
+
+class Trace:
+    """Rate-limited printing: at most rate lines per second.
+
+    The number of lines left out is noted now and again.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        # a rate below one a second still has to allow one line at a time
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.noted = self.last
+
+    def __call__(self, *args):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return
+        self.tokens -= 1
+        if self.suppressed and now - self.noted >= 1:
+            print(f'  ({self.suppressed} lines suppressed)')
+            self.suppressed = 0
+            self.noted = now
+        print(*args)
+
 # global variables
-myplant: "Plant" = None   # singleton instance
-mysel = selectors.DefaultSelector()
+stats = Stats()
+trace = Trace(10)
 
 
 class RegisterBlock:
@@ -60,27 +214,77 @@ class RegisterBlock:
     # first register, eg HR(0), IR(60)
     base: Register
 
-    # set of values - array for holding registers, any sequence type for input registers
-    values: Sequence[int]
+    # set of values, held as unsigned 16-bit array (or a memoryview
+    # of shared memory, once shared between worker processes)
+    values: array | memoryview
+
+    # Bumped on every write, so that cached responses built from an
+    # older version of the block can be spotted. A one-element array so
+    # that it can move into shared memory alongside the values.
+    _generation: array | memoryview
 
     def __init__(self, slave_addresses, base, values):
-        self.slave_addresses = slave_addresses
+        self.slave_addresses = tuple(slave_addresses)
         self.base = base
+        self.values = array('H', values)
+        self._generation = array('Q', [0])
+
+    @property
+    def generation(self):
+        return self._generation[0]
+
+    def write(self, offs, value):
+        """Store a new register value."""
+        self.values[offs] = value
+        self._generation[0] += 1
+
+    def shared_size(self):
+        """Number of bytes needed by share()."""
+        return 8 + (2 * len(self.values) + 7) // 8 * 8
+
+    def share(self, buf):
+        """Move the values and generation into buf, eg a slice of shared memory."""
+        generation = buf[:8].cast('Q')
+        generation[0] = self._generation[0]
+        values = buf[8:8 + 2 * len(self.values)].cast('H')
+        values[:] = self.values
+        self._generation = generation
         self.values = values
 
+    def release(self):
+        """Let go of the shared memory which share() moved us into."""
+        if isinstance(self.values, memoryview):
+            self.values.release()
+            self._generation.release()
+
     def __repr__(self):
         return f"RegisterBlock({self.slave_addresses}, {self.base}, (...)"
 
 class Plant:
     """Abstract base class for a plant."""
 
-    # A plant is just modelled as a collection of register blocks
-    # For any request, just need to search through the blocks to
-    # find the one targetted.
+    # A plant is just modelled as a collection of register blocks.
+    # On construction, the blocks are indexed by (slave address, register class),
+    # each entry being the list of blocks sorted by base register, and a parallel
+    # list of the base register numbers. Finding the block targetted by a request
+    # is then a dict lookup plus a bisect.
+    #
+    # Policy for requests which don't fit neatly inside one block:
+    # - a request whose first register is not in any block is ignored,
+    #   which seems to be what the inverter does for a register it doesn't have.
+    # - a read which starts in a block but runs past the end of it is served:
+    #   registers covered by later blocks are taken from them, and any
+    #   registers not covered by any block are returned as zero.
+    # - a write has to land on an existing register.
 
     # provided by specific plant sub-classes
     regblocks: ClassVar[Sequence[RegisterBlock]]
 
+    # serial numbers to put in the responses. Defaults are the
+    # globals above, but a snapshot can supply its own.
+    inverter_serial: str = INVERTER_SERIAL
+    dongle_serial: str = DONGLE_SERIAL
+
     # lookup table to choose appropriate TransparentResponse class
     # for any given request (based on transparent function code within).
     _lut: ClassVar[dict[int, TransparentResponse]] = {
@@ -89,50 +293,219 @@ class Plant:
         WRITEHOLDING: WriteHoldingRegisterResponse,
     }
 
+    # (slave_address, register class) -> (sorted base registers, blocks)
+    _index: dict[tuple[int, type], tuple[list[int], list[RegisterBlock]]]
+
+    # Encoded read responses, keyed by (slave_address, register class, base, count).
+    # Each entry also holds the (block, generation) of each block it was built from.
+    _cache: dict[tuple[int, type, int, int], tuple[bytes, tuple[tuple[RegisterBlock, int], ...]]]
+
+    # Blocks this plant has its own copy of. Blocks start out shared - with
+    # the class, or with the plant we were cloned from - and get copied
+    # on the first write. So a fleet of plants with the same personality only
+    # pays for the holding register blocks that have actually been written.
+    _owned: set[RegisterBlock]
+
+    # Held while writing to a block. Only needs to be a real lock once
+    # the holding registers are in shared memory - see share().
+    _lock = contextlib.nullcontext()
+
+    # encoded heartbeat request, built on first use
+    _heartbeat: bytes | None = None
+
+    def __init__(self):
+        self._cache = {}
+        self._owned = set()
+        self._index = {}
+        for b in sorted(self.regblocks, key=lambda b: int(b.base)):
+            for slave in b.slave_addresses:
+                bases, blocks = self._index.setdefault((slave, type(b.base)), ([], []))
+                bases.append(int(b.base))
+                blocks.append(b)
+
     def find_block(self, request):
-        """Find the block which contains the register(s) addressed by the request"""
-
-        # TODO - this rejects requests where count goes beyond supported registers
-        # should we instead, say, return just the registers available ?
-        # When asked for a holding register that doesn't exist, inverter seems
-        # to just ignore the request. But if asked for a range that starts valid
-        # and becomes invalid, should we ignore it, or give an error ?
-
-        for b in self.regblocks:
-            if (request.slave_address in b.slave_addresses and
-                request.register_class is type(b.base) and
-                request.base_register >= int(b.base) and
-                request.base_register + request.register_count <=  int(b.base) + len(b.values)
-            ):
-                return b
-        return None
+        """Find the block containing the first register addressed by the request.
+
+        Returns (block, offset) or None.
+        """
+
+        entry = self._index.get((request.slave_address, request.register_class))
+        if entry is None:
+            return None
+        bases, blocks = entry
+        i = bisect_right(bases, request.base_register) - 1
+        if i < 0:
+            return None
+        offs = request.base_register - bases[i]
+        if offs >= len(blocks[i].values):
+            return None
+        return blocks[i], offs
+
+    def overlapping(self, request):
+        """Yield (block, base register number) for each block overlapping a read request."""
+
+        bases, blocks = self._index[(request.slave_address, request.register_class)]
+        end = request.base_register + request.register_count
+        i = bisect_right(bases, request.base_register) - 1
+        while i < len(blocks) and bases[i] < end:
+            if bases[i] + len(blocks[i].values) > request.base_register:
+                yield blocks[i], bases[i]
+            i += 1
+
+    def read_values(self, request):
+        """Gather the register values for a read request, following the policy above."""
+
+        start = request.base_register
+        end = start + request.register_count
+        spans = list(self.overlapping(request))
+
+        # common case: entirely within one block
+        block, base = spans[0]
+        if end <= base + len(block.values):
+            return block.values[start - base:end - base].tolist()
+
+        values = [0] * request.register_count
+        for block, base in spans:
+            lo = max(start, base)
+            hi = min(end, base + len(block.values))
+            values[lo - start:hi - start] = block.values[lo - base:hi - base]
+        return values
 
     def process_request(self, request):
         """Given a TransparentRequest, compose a suitable TransparentResponse."""
 
-        block = self.find_block(request)
-        if block is None:
-            print("no register block found for ", request)
+        if request.transparent_function_code not in self._lut:
+            stats.unknown += 1
+            trace("unknown function code in ", request)
             return None
-
-        # otherwise we now need to construct a suitable response
-        offs = request.base_register - int(block.base)
-        count = request.register_count
+        found = self.find_block(request)
+        if found is None:
+            stats.unknown += 1
+            trace("no register block found for ", request)
+            return None
+        block, offs = found
 
         tfc = request.transparent_function_code
         if tfc == WRITEHOLDING:
-            block.values[offs] = request.register_values[0]
+            block = self.own(block)
+            with self._lock:
+                block.write(offs, request.register_values[0])
+        values = self.read_values(request)
 
         cls = self._lut[tfc]
         response = cls(slave_address = request.slave_address,
                        base_register = request.base_register,
                        register_count = request.register_count,
-                       register_values = block.values[offs:offs + count],
-                       inverter_serial_number = INVERTER_SERIAL,
-                       data_adapter_serial_number = DONGLE_SERIAL,
+                       register_values = values,
+                       inverter_serial_number = self.inverter_serial,
+                       data_adapter_serial_number = self.dongle_serial,
                        )
         return response
 
+    def respond(self, request):
+        """Given a TransparentRequest, return the encoded response, or None.
+
+        Clients tend to poll the same few pages over and over, so encoded
+        read responses are cached. Each cached response notes the generation
+        of every block it draws registers from, and is only used while none
+        of those blocks has been written to since. (Checking generations rather
+        than dropping entries on write means this works even when the write
+        was made by another worker process.)
+        """
+
+        tfc = request.transparent_function_code
+        if tfc == WRITEHOLDING or tfc not in self._lut:
+            # writes aren't cached, and process_request() turns away the rest
+            response = self.process_request(request)
+            return None if response is None else response.encode()
+
+        key = (request.slave_address, request.register_class, request.base_register, request.register_count)
+        entry = self._cache.get(key)
+        if entry is not None:
+            data, stamps = entry
+            if all(block.generation == gen for block, gen in stamps):
+                stats.cache_hits += 1
+                return data
+
+        # note the generations *before* reading the values, so that
+        # a write which races with us leaves a stale entry looking stale
+        if self.find_block(request) is None:
+            stats.unknown += 1
+            trace("no register block found for ", request)
+            return None
+        stamps = tuple((block, block.generation) for block, _ in self.overlapping(request))
+        response = self.process_request(request)
+        data = response.encode()
+
+        # Should only ever hold a handful of entries, but don't let
+        # an odd client make it grow without limit.
+        if len(self._cache) >= CACHE_LIMIT:
+            self._cache.clear()
+        self._cache[key] = (data, stamps)
+        return data
+
+    def own(self, block):
+        """Return our own copy of a block, copying it if it is currently shared."""
+
+        if block in self._owned:
+            return block
+        mine = RegisterBlock(block.slave_addresses, block.base, block.values)
+        for bases, blocks in self._index.values():
+            for i, b in enumerate(blocks):
+                if b is block:
+                    blocks[i] = mine
+        self._owned.add(mine)
+        # cached responses refer to the old block, whose generation won't change
+        self._cache.clear()
+        return mine
+
+    def clone(self, inverter_serial=None, dongle_serial=None):
+        """Make another plant with the same personality, sharing our register blocks."""
+
+        other = copy.copy(self)
+        other._cache = {}
+        other._heartbeat = None
+        other._owned = set()
+        other._index = {k: (bases, list(blocks)) for k, (bases, blocks) in self._index.items()}
+        if inverter_serial is not None:
+            other.inverter_serial = inverter_serial
+        if dongle_serial is not None:
+            other.dongle_serial = dongle_serial
+        return other
+
+    def heartbeat_request(self):
+        """Return an encoded heartbeat request, the same for every connection."""
+        if self._heartbeat is None:
+            self._heartbeat = HeartbeatRequest(data_adapter_serial_number=self.dongle_serial).encode()
+        return self._heartbeat
+
+    def holding_blocks(self):
+        """The distinct holding register blocks, ie the ones which can be written."""
+        blocks = {}
+        for (_, cls), (_, bs) in self._index.items():
+            if cls is HR:
+                blocks.update((id(b), b) for b in bs)
+        return list(blocks.values())
+
+    def shared_size(self):
+        """Number of bytes needed by share()."""
+        return sum(b.shared_size() for b in self.holding_blocks())
+
+    def share(self, buf, lock):
+        """Move our holding registers into buf, a slice of shared memory.
+
+        Worker processes forked afterwards then all see the same holding
+        register state. Input registers are never written, so can just be
+        inherited across the fork.
+        """
+        offs = 0
+        for block in self.holding_blocks():
+            block = self.own(block)
+            n = block.shared_size()
+            block.share(buf[offs:offs + n])
+            offs += n
+        self._lock = lock
+
 class HybridG3(Plant):
     """A concrete plant representing a third-gen hybrid (5kW, firmware 309/3015)"""
 
@@ -221,77 +594,353 @@ class HybridG3(Plant):
 
 
 
-# socket handling:
+# Personalities can also be loaded from snapshot files. These are json:
+#  {
+#    "description": "...",               (optional)
+#    "inverter_serial": "FD9876G543",    (optional)
+#    "dongle_serial": "WH1234G567",      (optional)
+#    "blocks": [
+#      {"slaves": [17, 48, 49, 50], "type": "HR", "base": 0, "values": "20010003..."},
+#      ...
+#    ]
+#  }
+# with the register values as a hex string, 4 digits (big-endian) per register.
+# replay2.py can generate one of these from a captured logfile, and
+# server.py --save will write out the current personality.
+
+_regtypes = {'HR': HR, 'IR': IR}
+
+class SnapshotPlant(Plant):
+    """A plant whose register blocks are loaded from a snapshot file."""
+
+    def __init__(self, filename):
+        with open(filename) as f:
+            snap = json.load(f)
+        self.description = snap.get('description', filename)
+        self.inverter_serial = snap.get('inverter_serial', INVERTER_SERIAL)
+        self.dongle_serial = snap.get('dongle_serial', DONGLE_SERIAL)
+        blocks = []
+        for b in snap['blocks']:
+            values = array('H', bytes.fromhex(b['values']))
+            if sys.byteorder == 'little':
+                values.byteswap()
+            blocks.append(RegisterBlock(b['slaves'], _regtypes[b['type']](b['base']), values))
+        self.regblocks = blocks
+        super().__init__()
+
+def write_snapshot(filename, regblocks, description=None, inverter_serial=None, dongle_serial=None):
+    """Write a set of register blocks out as a snapshot file."""
+
+    blocks = []
+    for b in regblocks:
+        values = array('H', b.values)
+        if sys.byteorder == 'little':
+            values.byteswap()
+        blocks.append({
+            'slaves': list(b.slave_addresses),
+            'type': type(b.base).__name__,
+            'base': int(b.base),
+            'values': values.tobytes().hex(),
+        })
+    snap = {}
+    if description is not None:
+        snap['description'] = description
+    if inverter_serial is not None:
+        snap['inverter_serial'] = inverter_serial
+    if dongle_serial is not None:
+        snap['dongle_serial'] = dongle_serial
+    snap['blocks'] = blocks
+    with open(filename, 'w') as f:
+        json.dump(snap, f, indent=1)
+        f.write('\n')
+
+# built-in personalities, selectable by name on the command line
+PERSONALITIES = {
+    'HybridG3': HybridG3,
+}
+
+def load_personality(name):
+    """Construct a plant from a built-in personality name or snapshot filename."""
+    if name in PERSONALITIES:
+        return PERSONALITIES[name]()
+    return SnapshotPlant(name)
 
 
-class SocketHandler:
-    """Abstract base class for handling sockets.
-    An instance is attached to the selector as the
-    key for each registered socket, and then ready()
-    is invoked when the socket becomes readable.
-    """
+# socket handling:
 
-    socket: socket.socket
 
-    def __init__(self, socket):
-        self.socket = socket
+class InverterEmulator(asyncio.Protocol):
+    """Emulate just enough of an inverter to fool client.
 
-    def ready(self):
-        """Invoked when the socket indicates that it is readable."""
-        raise NotImplementedError()
+    One instance per connection.
+    """
 
-class InverterEmulator(SocketHandler):
-    """Emulate just enough of an inverter to fool client."""
+    # the plant being emulated on this connection
+    plant: Plant
 
     # each instance needs its own framer
     framer: ServerFramer
 
-    def __init__(self, socket):
-        super().__init__(socket)
-        self.framer = ServerFramer()
+    transport: asyncio.Transport
 
-    def ready(self):
-        data = self.socket.recv(1024)
-        if data:
-            # print('  received {!r}'.format(data))
-            for request in self.framer.decode(data):
-                response = myplant.process_request(request)
-                print(request, " -> ", response)
-                if response is not None:
-                    self.socket.send(response.encode())
-        else:
-            # Interpret empty result as closed connection
-            print('  closing')
-            mysel.unregister(self.socket)
-            self.socket.close()
-
-class ServerSocketHandler(SocketHandler):
-    """Accept new connections."""
-    def ready(self):
-        sock, addr = self.socket.accept()
-        print('accept({})'.format(addr))
-        sock.setblocking(False)
-        mysel.register(sock, selectors.EVENT_READ, InverterEmulator(sock))
+    # In broadcast mode, the set of all connections to the same plant
+    # (including this one), and what to do when one falls behind:
+    # 'drop' or 'disconnect'. Otherwise None.
+    peers: set["InverterEmulator"] | None
+    slow_policy: str | None
 
-if __name__ == "__main__":
+    # number of broadcast frames this connection missed by being slow
+    dropped: int
 
-    # TODO: once we have more personalities, choose one from the command line
-    myplant = HybridG3()
+    # Seconds between heartbeat requests, or 0 for none. While
+    # awaiting_heartbeat is set, a request has been sent and not yet answered.
+    heartbeat_interval: float
+    awaiting_heartbeat: bool
+    missed_heartbeats: int
+    heartbeat_sent: float     # loop time the last heartbeat request was sent
+    timer: asyncio.TimerHandle | None
 
-    # establish listener socket, and add it to the select list
+    def __init__(self, plant, peers=None, slow_policy=None, heartbeat_interval=0):
+        self.plant = plant
+        self.framer = ServerFramer()
+        self.peers = peers
+        self.slow_policy = slow_policy
+        self.dropped = 0
+        self.heartbeat_interval = heartbeat_interval
+        self.awaiting_heartbeat = False
+        self.missed_heartbeats = 0
+        self.heartbeat_sent = 0.0
+        self.timer = None
+
+    def connection_made(self, transport):
+        trace('accept({})'.format(transport.get_extra_info('peername')))
+        stats.connections += 1
+        self.transport = transport
+        transport.set_write_buffer_limits(high=HIGH_WATER, low=LOW_WATER)
+        if self.peers is not None:
+            self.peers.add(self)
+        if self.heartbeat_interval:
+            self.timer = asyncio.get_running_loop().call_later(self.heartbeat_interval, self.send_heartbeat)
+
+    def send_heartbeat(self):
+        """Timer callback: time to send a heartbeat request."""
+        loop = asyncio.get_running_loop()
+        self.transport.write(self.plant.heartbeat_request())
+        self.awaiting_heartbeat = True
+        self.heartbeat_sent = loop.time()
+        self.timer = loop.call_later(min(HEARTBEAT_TIMEOUT, self.heartbeat_interval), self.heartbeat_timeout)
+
+    def heartbeat_timeout(self):
+        """Timer callback: the client has had long enough to answer the heartbeat."""
+        if self.awaiting_heartbeat:
+            self.awaiting_heartbeat = False
+            self.missed_heartbeats += 1
+            if self.missed_heartbeats >= HEARTBEAT_MISSES:
+                trace('  no heartbeat from', self.transport.get_extra_info('peername'))
+                self.timer = None
+                self.transport.abort()
+                return
+        # keep to the interval, measured from the last one sent
+        self.timer = asyncio.get_running_loop().call_at(
+            self.heartbeat_sent + self.heartbeat_interval, self.send_heartbeat)
+
+    def data_received(self, data):
+        # print('  received {!r}'.format(data))
+
+        # Time spent in the framer is whatever's left after taking
+        # out the time spent handling each request.
+        start = time.perf_counter_ns()
+        handling = 0
+
+        for request in self.framer.decode(data):
+            t0 = time.perf_counter_ns()
+            if isinstance(request, HeartbeatResponse):
+                stats.heartbeats += 1
+                # only counts if it arrives in time
+                if self.awaiting_heartbeat:
+                    self.awaiting_heartbeat = False
+                    self.missed_heartbeats = 0
+                handling += time.perf_counter_ns() - t0
+                continue
+            stats.requests[stats.names.get(request.transparent_function_code, 'other')] += 1
+            response = self.plant.respond(request)
+            t1 = time.perf_counter_ns()
+            stats.respond.add((t1 - t0) // 1000)
+            trace(request, " -> ", response and f"{len(response)} bytes")
+            if response is not None:
+                if self.peers is None:
+                    self.transport.write(response)
+                else:
+                    # (an abort() doesn't remove the peer until later,
+                    # so the set won't change under us)
+                    for peer in self.peers:
+                        if peer is self:
+                            self.transport.write(response)
+                        else:
+                            peer.broadcast(response)
+                stats.queue.add(self.transport.get_write_buffer_size())
+            handling += time.perf_counter_ns() - t0
+
+        stats.decode.add((time.perf_counter_ns() - start - handling) // 1000)
+
+    def broadcast(self, data):
+        """Send a frame that some other client asked for, unless we're too far behind."""
+
+        if self.transport.is_closing():
+            return
+        if self.transport.get_write_buffer_size() > BROADCAST_LIMIT:
+            self.dropped += 1
+            if self.slow_policy == 'disconnect':
+                trace('  disconnecting slow client', self.transport.get_extra_info('peername'))
+                self.transport.abort()
+            return
+        self.transport.write(data)
+
+    def pause_writing(self):
+        # client isn't keeping up with its responses - stop taking requests
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        trace('  closing', exc or '', f'(dropped {self.dropped} frames)' if self.dropped else '')
+        stats.connections -= 1
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.peers is not None:
+            self.peers.discard(self)
+
+
+def nth_serial(serial, n):
+    """Derive a serial number for the n'th member of a fleet by adding n to the trailing digits."""
+
+    if n == 0:
+        return serial
+    prefix = serial.rstrip('0123456789')
+    digits = serial[len(prefix):]
+    if not digits:
+        raise ValueError(f"can't number serial {serial}")
+    return prefix + f"{(int(digits) + n) % 10 ** len(digits):0{len(digits)}d}"
+
+def dump_stats(interval):
+    """Timer callback: print and reset the stats, then go again."""
+    stats.dump()
+    asyncio.get_running_loop().call_later(interval, dump_stats, interval)
+
+async def serve(plants, port, broadcast=None, heartbeat=0, stats_interval=0, reuse_port=False):
+    """Listen for connections and service them forever.
+
+    Each plant is served on its own port, starting from the one given.
+    broadcast is None, or the policy for slow connections ('drop' or 'disconnect').
+    heartbeat is the interval between heartbeat requests, or 0 for none.
+    stats_interval is how often to dump stats, or 0 for never.
+    """
 
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.setblocking(False)
-    server.bind(('', 8899))
-    server.listen(5)
+    loop = asyncio.get_running_loop()
+    if stats_interval:
+        stats.reset()
+        loop.call_later(stats_interval, dump_stats, stats_interval)
+    servers = []
+    for n, plant in enumerate(plants):
+        peers = set() if broadcast else None
+        servers.append(await loop.create_server(
+            lambda plant=plant, peers=peers: InverterEmulator(plant, peers, broadcast, heartbeat),
+            '', port + n, reuse_address=True, reuse_port=reuse_port))
+    await asyncio.gather(*[server.serve_forever() for server in servers])
+
+def worker(plants, port, broadcast, heartbeat, stats_interval):
+    """Entry point for a worker process."""
+    # the parent's SIGTERM handler is inherited across the fork
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        asyncio.run(serve(plants, port, broadcast, heartbeat, stats_interval, reuse_port=True))
+    except KeyboardInterrupt:
+        pass
+
+def serve_workers(plants, port, broadcast, heartbeat, stats_interval, workers):
+    """Serve the plants from several worker processes, all listening on the same ports.
+
+    The holding registers of all the plants go into one shared memory segment
+    before the workers are forked, so a write made through any worker is seen
+    by clients of all of them. The kernel spreads incoming connections across
+    the workers (SO_REUSEPORT). On ^C or SIGTERM, the workers are stopped
+    before the shared memory is removed.
+    """
+
+    def terminate(signum, frame):
+        raise SystemExit(128 + signum)
+
+    shm = SharedMemory(create=True, size=max(1, sum(p.shared_size() for p in plants)))
+    try:
+        lock = multiprocessing.Lock()
+        offs = 0
+        for plant in plants:
+            n = plant.shared_size()
+            plant.share(shm.buf[offs:offs + n], lock)
+            offs += n
+
+        ctx = multiprocessing.get_context('fork')
+        procs = [ctx.Process(target=worker, args=(plants, port, broadcast, heartbeat, stats_interval)) for _ in range(workers)]
+        previous = signal.signal(signal.SIGTERM, terminate)
+        try:
+            for proc in procs:
+                proc.start()
+            for proc in procs:
+                proc.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+            for proc in procs:
+                if proc.pid is not None:
+                    proc.join()
+    finally:
+        # need to drop our views of the shared memory before it can be closed
+        for plant in plants:
+            for block in plant.holding_blocks():
+                block.release()
+        shm.close()
+        shm.unlink()
 
-    mysel = selectors.DefaultSelector()
-    mysel.register(server, selectors.EVENT_READ, ServerSocketHandler(server))
 
-    # now just service socket activity forever
-    while True:
-        print('waiting for I/O')
-        for key, mask in mysel.select(timeout=5):
-            handler = key.data
-            handler.ready()  # either accept new socket, or process request
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pretend to be an inverter")
+    parser.add_argument('personality', nargs='?', default='HybridG3',
+                        help=f"built-in personality ({', '.join(PERSONALITIES)}) or snapshot file")
+    parser.add_argument('-p', '--port', type=int, default=8899)
+    parser.add_argument('-n', '--count', type=int, default=1,
+                        help="number of inverters to emulate, on consecutive ports, with consecutive serial numbers")
+    parser.add_argument('-b', '--broadcast', nargs='?', const='drop', choices=('drop', 'disconnect'),
+                        help="send every response to all clients, like the dongle does. "
+                        "Optional argument says what to do with a client which falls behind.")
+    parser.add_argument('--heartbeat', type=float, default=0, metavar='SECS',
+                        help="send heartbeat requests this often, and drop clients which don't answer "
+                        "(the dongle uses 180)")
+    parser.add_argument('--stats', type=float, default=0, metavar='SECS',
+                        help="print request counts and timings this often")
+    parser.add_argument('--trace', type=float, default=10, metavar='N',
+                        help="print at most N lines per second about individual requests (default 10, 0 for none)")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="number of worker processes to serve connections")
+    parser.add_argument('--save', metavar='FILE',
+                        help="write the personality out as a snapshot file, and exit")
+    args = parser.parse_args()
+
+    trace = Trace(args.trace)
+    template = load_personality(args.personality)
+
+    if args.save:
+        write_snapshot(args.save, template.regblocks, description=args.personality,
+                       inverter_serial=template.inverter_serial, dongle_serial=template.dongle_serial)
+    else:
+        plants = [template.clone(nth_serial(template.inverter_serial, n),
+                                 nth_serial(template.dongle_serial, n))
+                  for n in range(args.count)]
+        if args.workers > 1:
+            serve_workers(plants, args.port, args.broadcast, args.heartbeat, args.stats, args.workers)
+        else:
+            asyncio.run(serve(plants, args.port, args.broadcast, args.heartbeat, args.stats))
@@ -2,26 +2,114 @@
 
 # Set regs from command line.
 # Intended to have same interface as the api one.
-
+#
+#   python setreg.py host cp            # read battery_charge_limit
+#   python setreg.py host cp=50 dp=50   # write
+#
+# Only the registers named are read (not a full refresh), and the writes
+# are all sent together, each reported as soon as it has been confirmed.
+#
+# Holding register values read or written are remembered in an on-disk
+# cache (see hrcache.py). With --max-age SECS, a query is answered from
+# the cache if the values there are recent enough, without asking the
+# inverter at all.
+#
+#   python setreg.py host cp --max-age 3600
+
+import argparse
 import asyncio
 import logging
 import socket
 import sys
+import time
 from typing import Callable, Dict, List, Optional, Tuple
 
 from givenergy_modbus.exceptions import CommunicationError, ExceptionBase
 from givenergy_modbus.client.client import Client
 from givenergy_modbus.model.plant import Plant, Inverter
+from givenergy_modbus.model.register import HR, IR
 from givenergy_modbus.pdu import WriteHoldingRegisterRequest
+from givenergy_modbus.pdu.transparent import (
+    ReadHoldingRegistersRequest,
+    ReadHoldingRegistersResponse,
+    ReadInputRegistersRequest,
+)
+
+from hrcache import DEFAULT_FILE, MAX_READ, HRCache
 
 _logger = logging.getLogger(__name__)
 
+# settings are on the inverter
+SLAVE = 0x32
+
+TIMEOUT = 2.0
+RETRIES = 2
+
 
 class MyPlant(Plant):
     def holding_register_updated(self, reg: int, value: int):
         print(f'holding reg {reg} now {value}')
 
-async def get_set_regs():
+def read_requests(names):
+    """Requests to read just the registers behind the named settings.
+
+    Registers close enough together are read in the same request.
+    """
+
+    regs = {}  # register class -> register numbers
+    for name in names:
+        for reg in Inverter.REGISTER_LUT[name].registers:
+            regs.setdefault(type(reg), set()).add(int(reg))
+
+    requests = []
+    for cls, numbers in regs.items():
+        request = ReadInputRegistersRequest if cls is IR else ReadHoldingRegistersRequest
+        base = None
+        for n in sorted(numbers):
+            if base is not None and n - base >= MAX_READ:
+                requests.append(request(slave_address=SLAVE, base_register=base, register_count=last - base + 1))
+                base = None
+            if base is None:
+                base = n
+            last = n
+        if base is not None:
+            requests.append(request(slave_address=SLAVE, base_register=base, register_count=last - base + 1))
+    return requests
+
+async def timed_write(client, cache, host, reg, val, request):
+    """Write one setting, reporting (and caching) the result as soon as it's known.
+
+    Returns whether it was confirmed.
+    """
+    start = time.perf_counter()
+    try:
+        response, = await client.execute([request], TIMEOUT, RETRIES)
+    except Exception as e:
+        print(f'{reg} = {val} failed: {e!r}')
+        return False
+    elapsed = time.perf_counter() - start
+    if response.error:
+        print(f'{reg} = {val} rejected ({elapsed * 1000:.0f} ms)')
+        return False
+    print(f'{reg} = {val} confirmed in {elapsed * 1000:.0f} ms')
+    cache.update(host, response)
+    return True
+
+def from_cache(cache, host, plant, names, max_age):
+    """Feed the plant any of the named settings which are in the cache and fresh enough.
+
+    Returns the names which still need to be read from the inverter.
+    """
+
+    regs = [int(reg) for name in names for reg in Inverter.REGISTER_LUT[name].registers if type(reg) is HR]
+    responses, stale = cache.responses(host, regs, max_age, SLAVE)
+    for response in responses:
+        plant.update(response)
+    stale = set(stale)
+    return [name for name in names
+            if any(type(reg) is not HR or int(reg) in stale for reg in Inverter.REGISTER_LUT[name].registers)]
+
+async def get_set_regs(args):
 
     shorthand = {
         'cp': 'battery_charge_limit',
@@ -29,44 +117,65 @@ async def get_set_regs():
         'pt': 'battery_pause_mode',
         }
 
-    client = Client(sys.argv[1], 8899)
+    client = Client(args.host, 8899)
     plant = MyPlant()
     plant.max_holding_reg=300
     client.plant=plant
+    cache = HRCache(args.cache)
 
-    # first pass over the args to see if any are reads
-    query = False
-    for arg in [x.split('=', 1) for x in sys.argv[2:]]:
-        if len(arg) == 1:
-            query = True
-
-    await client.connect()
-    inverter = None
-
-    if query:
-        await client.refresh_plant(True)
-        inverter = client.plant.inverter
-        
-    # another pass over the args, performing each in turn
-    settings = []
-    for arg in [x.split('=', 1) for x in sys.argv[2:]]:
+    # first pass over the args to find the reads and writes
+    queries = []
+    writes = []
+    for arg in [x.split('=', 1) for x in args.settings]:
         reg = arg[0]
         if reg in shorthand:
             reg = shorthand[reg]
-
+        if reg not in Inverter.REGISTER_LUT:
+            sys.exit(f'unknown register {reg}')
         if len(arg) == 1:
-            # just retrieve the setting
-            print(reg, '=', inverter.get(reg))
+            queries.append(reg)
         else:
-            val = int(arg[1])
-            settings.append(client.commands.write_named_register(reg, val))
+            writes.append((reg, int(arg[1])))
 
-    if len(settings) > 0:
-        client.execute(settings, 2.0, 2)
-    await asyncio.sleep(5)
+    reads = from_cache(cache, args.host, plant, queries, args.max_age) if args.max_age else queries
+    if not reads and not writes:
+        # nothing to ask the inverter
+        for reg in queries:
+            print(reg, '=', plant.inverter.get(reg))
+        return
 
-    await client.close()
+    await client.connect()
+    confirmed = []
+    try:
+        if queries:
+            # the client updates the plant with the responses
+            if reads:
+                for response in await client.execute(read_requests(reads), TIMEOUT, RETRIES):
+                    if isinstance(response, ReadHoldingRegistersResponse) and not response.error:
+                        cache.update(args.host, response)
+            inverter = client.plant.inverter
+            for reg in queries:
+                print(reg, '=', inverter.get(reg))
+
+        if writes:
+            # execute() would wait for the slowest before returning anything,
+            # so run each write separately, but all at once
+            requests = [client.commands.write_named_register(reg, val) for reg, val in writes]
+            confirmed = await asyncio.gather(*[timed_write(client, cache, args.host, reg, val, request)
+                                              for (reg, val), request in zip(writes, requests)])
+    finally:
+        await client.close()
+        cache.save()
+    if not all(confirmed):
+        sys.exit(1)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(get_set_regs())
+    parser = argparse.ArgumentParser(description="Read and write inverter settings")
+    parser.add_argument('host')
+    parser.add_argument('settings', nargs='*', help="name to read it, name=value to write it")
+    parser.add_argument('--max-age', type=float, default=0, metavar='SECS',
+                        help="answer queries from the cache if its values are no older than this")
+    parser.add_argument('--cache', default=DEFAULT_FILE, help="holding register cache file")
+    # the settings may come before or after the options
+    asyncio.run(get_set_regs(parser.parse_intermixed_args()))
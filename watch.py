@@ -3,35 +3,217 @@
 # This exploits that the fact that the givenergy dongle appears to broadcast
 # modbus responses to all connected tcp clients, not just the one that made
 # the request. So simply connect and passively watch what comes through.
-# This doesn't respond to the heartbeat request, so the connection will get shut
-# down after a few minutes.
+#
+# Several inverters can be watched at once, from the one process. Each gets
+# its own connection, which answers the dongle's heartbeat requests (otherwise
+# the dongle shuts the connection down after a few minutes), and is made again,
+# with increasing delays, if it fails. Unless --passive, the plant data is also
+# refreshed every --refresh seconds, rather than relying on someone else to ask.
+#
+# Traffic can be recorded to a file, which replay2.py can play back later.
+# The recording (see recorder.py) is done in a background thread, with
+# the time each piece of data was received.
+#
+# With --hrcache, holding register values which go past are saved in the
+# cache which setreg.py uses (see hrcache.py), so it has less need to ask.
+#
+#   python watch.py 192.168.0.10 -r capture.rec.gz
+#   python watch.py 192.168.0.10 192.168.0.11 -r '{host}.rec.gz'
 
+import argparse
 import asyncio
-import gzip
 import logging
-import socket
-import sys
-from typing import Callable, Dict, List, Optional, Tuple
+import random
+import time
 
-from givenergy_modbus.exceptions import CommunicationError, ExceptionBase
-from givenergy_modbus.client.client import Client
+from givenergy_modbus.exceptions import ExceptionBase
 from givenergy_modbus.client import commands
 from givenergy_modbus.model.plant import Plant
+from givenergy_modbus.pdu import HeartbeatRequest, TransparentResponse
+from givenergy_modbus.pdu.framer import ClientFramer
+from givenergy_modbus.pdu.transparent import READHOLDING, WRITEHOLDING
+
+from hrcache import DEFAULT_FILE, HRCache
+
+from recorder import Recorder
 
 _logger = logging.getLogger(__name__)
 
+# seconds to wait before reconnecting: doubles after each failure, up to the max
+BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+
+# ... and goes back to the start once a connection has lasted this long
+STABLE = 60.0
+
+# the dongle sends a heartbeat every few minutes, so if nothing at all
+# has arrived for this long, assume the connection is dead
+IDLE_TIMEOUT = 600.0
+
+
+class Watcher:
+    """Watch one inverter, keeping a connection to it open."""
+
+    def __init__(self, host, port=8899, recorder=None, refresh=30.0, full_refresh=300.0, batteries=1,
+                 hrcache=None):
+        self.host = host
+        self.port = port
+        self.name = host if port == 8899 else f'{host}:{port}'
+        self.recorder = recorder
+        self.refresh = refresh              # seconds between refreshes (0 for passive)
+        self.full_refresh = full_refresh    # seconds between refreshes which include holding registers
+        self.batteries = batteries
+        self.hrcache = hrcache
+        self.plant = Plant()
+        self.connects = 0
+        self.connected = None    # time.monotonic() of the last connect
+        self.frames = 0
+        self.heartbeats = 0
+
+    async def run(self):
+        """Keep watching, reconnecting as necessary. Never returns."""
+
+        backoff = BACKOFF
+        while True:
+            self.connected = None
+            try:
+                await self.session()
+                _logger.warning(f'{self.name}: connection closed')
+            except (OSError, asyncio.TimeoutError) as e:
+                _logger.warning(f'{self.name}: {e!r}')
+            except Exception:
+                # don't let one inverter stop the others being watched
+                # (CancelledError isn't an Exception, so still gets through)
+                _logger.exception(f'{self.name}: session failed')
+            if self.connected is not None and time.monotonic() - self.connected >= STABLE:
+                # it was working for a while, so start again from short delays
+                backoff = BACKOFF
+            # a bit of jitter, so a fleet doesn't all come back at once
+            delay = backoff * random.uniform(0.75, 1.25)
+            _logger.info(f'{self.name}: reconnecting in {delay:.1f}s')
+            await asyncio.sleep(delay)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    async def session(self):
+        """One connection, until it fails."""
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), 10.0)
+        self.connects += 1
+        self.connected = time.monotonic()
+        _logger.info(f'{self.name}: connected')
+        tasks = [asyncio.create_task(self.receiver(reader, writer))]
+        if self.refresh:
+            tasks.append(asyncio.create_task(self.refresher(writer)))
+        try:
+            # the refresher only finishes if it fails, and then the session is over too
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()    # raises whatever it failed with
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def receiver(self, reader, writer):
+        """Handle whatever arrives, until the connection closes."""
+
+        framer = ClientFramer()
+        while True:
+            data = await asyncio.wait_for(reader.read(65536), IDLE_TIMEOUT)
+            if not data:
+                return
+            if self.recorder:
+                self.recorder.write(data)
+            try:
+                for message in framer.decode(data):
+                    self.frames += 1
+                    if isinstance(message, HeartbeatRequest):
+                        self.heartbeats += 1
+                        writer.write(message.expected_response().encode())
+                    elif isinstance(message, TransparentResponse):
+                        self.plant.update(message)
+                        if (self.hrcache and not message.error
+                                and message.transparent_function_code in (READHOLDING, WRITEHOLDING)):
+                            self.hrcache.update(self.host, message)
+            except (ExceptionBase, NotImplementedError) as e:
+                _logger.info(f'{self.name}: {e}')
+
+    async def refresher(self, writer):
+        """Ask for the plant data every so often."""
+
+        last_full = None
+        while True:
+            now = time.monotonic()
+            full = last_full is None or now - last_full >= self.full_refresh
+            if full:
+                last_full = now
+            for request in commands.refresh_plant_data(full, self.batteries):
+                writer.write(request.encode())
+            await writer.drain()
+            await asyncio.sleep(self.refresh)
+
+
+async def report(watchers, interval, hrcache):
+    """Log a line per inverter every so often (and save the holding register cache)."""
+    while True:
+        await asyncio.sleep(interval)
+        if hrcache:
+            hrcache.save()
+        for w in watchers:
+            dropped = f', {w.recorder.dropped} recorder drops' if w.recorder and w.recorder.dropped else ''
+            _logger.info(f'{w.name}: {w.connects} connects, {w.frames} frames, {w.heartbeats} heartbeats{dropped}')
+
 
-async def watch():
-    """Passively watch modbus traffic."""
+async def watch(args):
+    """Watch modbus traffic from all the inverters."""
 
-    capture = None
-    if len(sys.argv) > 2:
-        fname = sys,argv[2]
-        capture = gzip.GzipFile(fname, "wb") if fname.endswith(".gz") else open(fname, "wb")
-    client = Client(sys.argv[1], 8899, recorder=capture)
-    await client.watch_plant(None, timeout=5.0, refresh_period=30.0, passive=False, max_batteries=2)
+    watchers = []
+    hrcache = HRCache(args.hrcache) if args.hrcache else None
+    try:
+        for spec in args.hosts:
+            host, _, port = spec.partition(':')
+            recorder = None
+            if args.record:
+                recorder = Recorder(args.record.format(host=spec.replace(':', '-')),
+                                    rotate_size=args.rotate_size, rotate_time=args.rotate_time)
+            watchers.append(Watcher(host, int(port) if port else args.port, recorder,
+                                    0 if args.passive else args.refresh, batteries=args.batteries,
+                                    hrcache=hrcache))
+        await asyncio.gather(*[w.run() for w in watchers], report(watchers, args.report, hrcache))
+    finally:
+        if hrcache:
+            hrcache.save()
+        for w in watchers:
+            if w.recorder:
+                w.recorder.close()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    asyncio.run(watch())
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Watch the traffic to and from inverters")
+    parser.add_argument('hosts', nargs='+', help="host, or host:port")
+    parser.add_argument('-p', '--port', type=int, default=8899)
+    parser.add_argument('-r', '--record', metavar='FILE',
+                        help="record traffic to this file (compressed if it ends in .gz). "
+                             "With more than one host, include {host} in the name")
+    parser.add_argument('--rotate-size', type=int, default=0, metavar='BYTES',
+                        help="start a new recording file after this many bytes")
+    parser.add_argument('--rotate-time', type=float, default=0, metavar='SECS',
+                        help="start a new recording file after this many seconds")
+    parser.add_argument('--passive', action='store_true',
+                        help="don't send any requests, just watch (and answer heartbeats)")
+    parser.add_argument('--refresh', type=float, default=30.0, metavar='SECS',
+                        help="seconds between requests for the plant data")
+    parser.add_argument('--batteries', type=int, default=1, help="number of batteries to ask about")
+    parser.add_argument('--hrcache', nargs='?', const=DEFAULT_FILE, metavar='FILE',
+                        help=f"save holding register values seen in the cache setreg.py uses (default {DEFAULT_FILE})")
+    parser.add_argument('--report', type=float, default=300.0, metavar='SECS',
+                        help="seconds between logging a summary for each inverter")
+    args = parser.parse_args()
+    if len(args.hosts) > 1 and args.record and '{host}' not in args.record:
+        parser.error("with more than one host, the --record filename needs {host} in it")
+    try:
+        asyncio.run(watch(args))
+    except KeyboardInterrupt:
+        pass